@@ -0,0 +1,255 @@
+"""
+benchmark the training step, each function in representation.py, and each scorer in evaluation.py,
+on a synthetic corpus, so that no data or file server is needed.
+
+results are saved as json, and compared to the most recent previous results, if any.
+only compare results made on the same machine.
+"""
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+
+from preppy import Prep
+
+from childesrnnlm import configs
+from childesrnnlm.device import get_device
+from childesrnnlm.evaluation import update_pp_performance, update_ba_performance, update_cs_performance, \
+    update_dp_performance, update_si_performance, update_sd_performance
+from childesrnnlm.params import Params
+from childesrnnlm.pipeline import BatchPrefetcher
+from childesrnnlm.profiling import Profiler
+from childesrnnlm.representation import RepresentationCache, make_window_index, make_representations_with_context, \
+    make_representations_without_context, make_output_representations
+from childesrnnlm.rnn import RNN
+from childesrnnlm.training import make_optimizer, train_step
+
+RESULTS_PATH: Path = configs.Dirs.root / 'benchmarks' / 'results'
+SEED: int = 1
+
+# synthetic corpus
+NUM_TOKENS: int = 200_000
+NUM_TYPES: int = 4096
+ZIPF_EXPONENT: float = 1.1
+NUM_PROBES: int = 720  # about as many as in the largest structure
+NUM_CATEGORIES: int = 30
+STRUCTURE_NAME: str = 'synthetic'
+
+# training
+FLAVORS: List[str] = ['srn', 'lstm']
+HIDDEN_SIZES: List[int] = [64, 512]
+CONTEXT_SIZES: List[int] = [4, 8]
+BATCH_SIZES: List[int] = [64, 256]
+NUM_WARMUP_STEPS: int = 10
+NUM_TIMED_STEPS: int = 50
+
+# evaluation
+EVAL_FLAVOR: str = 'srn'
+EVAL_HIDDEN_SIZE: int = 512
+EVAL_CONTEXT_SIZE: int = 4
+NUM_REPEATS: int = 3
+
+
+def make_tokens() -> List[str]:
+    """
+    sample tokens from a zipfian distribution, so that word frequencies are similar to those of natural language
+    """
+    ranks = np.arange(1, NUM_TYPES + 1)
+    probabilities = ranks ** -ZIPF_EXPONENT / np.sum(ranks ** -ZIPF_EXPONENT)
+    token_ids = np.random.choice(NUM_TYPES, size=NUM_TOKENS, p=probabilities)
+    return [f'w{i}' for i in token_ids]
+
+
+def make_prep(tokens: List[str],
+              context_size: int,
+              batch_size: int,
+              ) -> Prep:
+    return Prep(tokens,
+                reverse=False,
+                sliding=False,
+                num_parts=2,
+                num_iterations=(1, 1),
+                batch_size=batch_size,
+                context_size=context_size,
+                shuffle_within_part=False,
+                min_num_test_tokens=0,
+                disallow_non_ascii=False,
+                )
+
+
+def make_probe2cat(prep: Prep,
+                   ) -> Dict[str, str]:
+    """
+    assign types of medium frequency to categories, so that each probe has many but not too many contexts
+    """
+    probes = [f'w{i}' for i in range(100, 100 + NUM_PROBES) if f'w{i}' in prep.token2id]
+    return {p: f'CAT{n % NUM_CATEGORIES}' for n, p in enumerate(probes)}
+
+
+def measure(fn: Callable[[], None],
+            num_repeats: int,
+            ) -> Dict[str, float]:
+    """
+    call fn once without timing (e.g. to fill caches), and then num_repeats times
+    """
+    fn()
+    seconds = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return {'median_seconds': statistics.median(seconds), 'min_seconds': min(seconds)}
+
+
+def benchmark_training(tokens: List[str],
+                       device: torch.device,
+                       ) -> List[Dict[str, float]]:
+    """
+    measure steady-state throughput of training.train_step(), which is also used by job.py,
+    including batching and the host-to-device copy
+    """
+    res = []
+    for context_size in CONTEXT_SIZES:
+        for batch_size in BATCH_SIZES:
+            prep = make_prep(tokens, context_size, batch_size)
+            for flavor in FLAVORS:
+                for hidden_size in HIDDEN_SIZES:
+                    params = Params.from_param2val({'flavor': flavor,
+                                                    'hidden_size': hidden_size,
+                                                    'context_size': context_size,
+                                                    'batch_size': batch_size})
+                    model = RNN(flavor, prep.num_types, hidden_size, 1, device)
+                    optimizer = make_optimizer(model.parameters(), params)
+                    profiler = Profiler(enabled=False, device=device)
+
+                    batches = BatchPrefetcher(islice(prep.generate_batches(), NUM_WARMUP_STEPS + NUM_TIMED_STEPS),
+                                              device, configs.Pipeline.prefetch_depth)
+                    start = None
+                    for step, (inputs, targets) in enumerate(batches):
+                        if step == NUM_WARMUP_STEPS:
+                            if device.type == 'cuda':
+                                torch.cuda.synchronize(device)
+                            start = time.perf_counter()
+                        train_step(model, model, optimizer, inputs, targets, params, profiler)
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize(device)
+                    seconds = time.perf_counter() - start
+
+                    steps_per_second = NUM_TIMED_STEPS / seconds
+                    res.append({'flavor': flavor,
+                                'hidden_size': hidden_size,
+                                'context_size': context_size,
+                                'batch_size': batch_size,
+                                'steps_per_second': steps_per_second,
+                                'tokens_per_second': steps_per_second * batch_size,
+                                })
+                    print(f'{flavor:<4} hidden_size={hidden_size:<4} context_size={context_size:<2} '
+                          f'batch_size={batch_size:<4} steps/sec={steps_per_second:>8.1f}', flush=True)
+    return res
+
+
+def benchmark_evaluation(tokens: List[str],
+                         device: torch.device,
+                         ) -> Dict[str, Dict[str, float]]:
+    """
+    measure wall time of each function in representation.py, and of each scorer in evaluation.py.
+    scorers are timed with representations already made, so that the time to make them is not attributed to scorers.
+    """
+    prep = make_prep(tokens, EVAL_CONTEXT_SIZE, batch_size=64)
+    model = RNN(EVAL_FLAVOR, prep.num_types, EVAL_HIDDEN_SIZE, 1, device)
+    model.eval()
+    probe2cat = make_probe2cat(prep)
+    probes = sorted(probe2cat)
+    probe_token_ids = [prep.token2id[p] for p in probes]
+    structure2probe2cat = {STRUCTURE_NAME: probe2cat}
+    print(f'Benchmarking evaluation with {len(probes)} probes in {NUM_CATEGORIES} categories', flush=True)
+
+    rep_cache = RepresentationCache(model, prep, 0, probe_token_ids)
+    for kind in ['o', 'n', 'output']:
+        rep_cache.get(kind, probe_token_ids)
+
+    name2fn = {
+        'make_window_index': lambda: make_window_index(prep.reordered_windows),
+        'make_representations_with_context': lambda: make_representations_with_context(model, probe_token_ids, prep),
+        'make_representations_without_context': lambda: make_representations_without_context(model, probe_token_ids),
+        'make_output_representations': lambda: make_output_representations(model, probes, prep),
+        'update_pp_performance': lambda: update_pp_performance({'train_pp': [], 'test_pp': []}, model, prep),
+        'update_ba_performance': lambda: update_ba_performance({}, prep, structure2probe2cat, rep_cache),
+        'update_cs_performance': lambda: update_cs_performance({}, prep, structure2probe2cat, rep_cache),
+        'update_dp_performance': lambda: update_dp_performance({}, prep, structure2probe2cat, rep_cache),
+        'update_si_performance': lambda: update_si_performance({}, prep, structure2probe2cat, rep_cache),
+        'update_sd_performance': lambda: update_sd_performance({}, prep, structure2probe2cat, rep_cache),
+    }
+    res = {}
+    for name, fn in name2fn.items():
+        res[name] = measure(fn, NUM_REPEATS)
+        print(f'{name:<40} {res[name]["median_seconds"]:>8.3f}s', flush=True)
+    return res
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=configs.Dirs.root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict,
+            results_previous: Dict,
+            ) -> None:
+    """
+    print ratio of new to previous wall time of each benchmark - values above 1 indicate a regression
+    """
+    def to_name2seconds(r: Dict) -> Dict[str, float]:
+        name2seconds = {name: m['median_seconds'] for name, m in r['evaluation'].items()}
+        for m in r['training']:
+            name = f'train_{m["flavor"]}_h{m["hidden_size"]}_c{m["context_size"]}_b{m["batch_size"]}'
+            name2seconds[name] = 1 / m['steps_per_second']
+        return name2seconds
+
+    name2seconds = to_name2seconds(results)
+    name2seconds_previous = to_name2seconds(results_previous)
+    print(f'Compared to commit={results_previous["commit"]} on {results_previous["date"]}:')
+    for name, seconds in name2seconds.items():
+        if name in name2seconds_previous:
+            print(f'{name:<40} {seconds / name2seconds_previous[name]:>6.2f}x')
+
+
+np.random.seed(SEED)
+torch.manual_seed(SEED)
+configs.Eval.structures = [STRUCTURE_NAME]
+
+device = get_device()
+tokens = make_tokens()
+results = {
+    'date': datetime.now().isoformat(timespec='seconds'),
+    'commit': get_commit(),
+    'platform': platform.platform(),
+    'python': platform.python_version(),
+    'torch': torch.__version__,
+    'device': str(device),
+    'num_threads': torch.get_num_threads(),
+    'training': benchmark_training(tokens, device),
+    'evaluation': benchmark_evaluation(tokens, device),
+}
+
+# compare to previous results before saving new results
+RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+paths_previous = sorted(RESULTS_PATH.glob('*.json'))
+if paths_previous:
+    with paths_previous[-1].open() as f:
+        compare(results, json.load(f))
+
+path = RESULTS_PATH / f'{datetime.now():%Y-%m-%d_%H-%M-%S}.json'
+with path.open('w') as f:
+    json.dump(results, f, indent=4)
+print(f'Saved benchmark results to {path}')
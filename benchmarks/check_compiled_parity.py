@@ -0,0 +1,89 @@
+"""
+check that compiled forward passes (TorchScript, and torch.compile if available),
+and forward passes under bfloat16 autocast, match the eager model.
+
+outputs and gradients of each compiled model are compared to those of the eager model on random inputs.
+exits with an error if any difference exceeds its tolerance.
+"""
+import sys
+from typing import Callable, Dict, List
+
+import torch
+
+from childesrnnlm import configs
+from childesrnnlm.device import get_device, autocast
+from childesrnnlm.rnn import RNN, ScriptedRNN
+
+SEED: int = 1
+FLAVORS: List[str] = ['srn', 'lstm']
+NUM_TYPES: int = 1000
+HIDDEN_SIZE: int = 64
+CONTEXT_SIZE: int = 7
+BATCH_SIZE: int = 32
+TOLERANCE_COMPILED: float = 1e-5
+TOLERANCE_AUTOCAST: float = 5e-2  # bfloat16 has only 8 bits of precision
+
+
+def run(forward_model: Callable,
+        model: RNN,
+        inputs: torch.LongTensor,
+        targets: torch.LongTensor,
+        ) -> Dict[str, torch.Tensor]:
+    """
+    return logits, last encodings, and gradients of all parameters, after one forward and backward pass
+    """
+    model.zero_grad()
+    output = forward_model(inputs)
+    loss = torch.nn.functional.cross_entropy(output['logits'].float(), targets)
+    loss.backward()
+    res = {'logits': output['logits'].detach().float(),
+           'last_encodings': output['last_encodings'].detach().float()}
+    for name, param in model.named_parameters():
+        res[f'grad_{name}'] = param.grad.detach().clone()
+    return res
+
+
+def compare(name2tensor_eager: Dict[str, torch.Tensor],
+            name2tensor: Dict[str, torch.Tensor],
+            tolerance: float,
+            label: str,
+            ) -> bool:
+    is_ok = True
+    for name, tensor_eager in name2tensor_eager.items():
+        max_diff = (tensor_eager - name2tensor[name]).abs().max().item()
+        is_ok_name = max_diff <= tolerance
+        is_ok = is_ok and is_ok_name
+        print(f'{label:<32} {name:<24} max abs diff={max_diff:.2e} {"ok" if is_ok_name else "FAILED"}')
+    return is_ok
+
+
+torch.manual_seed(SEED)
+device = get_device()
+is_ok_all = True
+for flavor in FLAVORS:
+    model = RNN(flavor, NUM_TYPES, HIDDEN_SIZE, 1, device)
+    inputs = torch.randint(0, NUM_TYPES, (BATCH_SIZE, CONTEXT_SIZE), device=device)
+    targets = torch.randint(0, NUM_TYPES, (BATCH_SIZE,), device=device)
+    name2tensor_eager = run(model, model, inputs, targets)
+
+    # compiled forward passes
+    label2forward_model = {f'{flavor} torchscript': ScriptedRNN(model)}
+    if hasattr(torch, 'compile'):
+        label2forward_model[f'{flavor} torch.compile'] = torch.compile(model)
+    for label, forward_model in label2forward_model.items():
+        name2tensor = run(forward_model, model, inputs, targets)
+        is_ok_all = compare(name2tensor_eager, name2tensor, TOLERANCE_COMPILED, label) and is_ok_all
+
+    # mixed precision forward pass - only outputs are compared, because gradients of small parameters differ a lot
+    if hasattr(torch, 'autocast'):
+        configs.Device.autocast_bf16 = True
+        with autocast(device):
+            name2tensor = run(model, model, inputs, targets)
+        configs.Device.autocast_bf16 = False
+        name2tensor_eager_outputs = {name: name2tensor_eager[name] for name in ['logits', 'last_encodings']}
+        is_ok_all = compare(name2tensor_eager_outputs, name2tensor, TOLERANCE_AUTOCAST, f'{flavor} autocast bf16') \
+            and is_ok_all
+
+if not is_ok_all:
+    sys.exit('Compiled or mixed precision forward passes do not match the eager model.')
+print('All compiled and mixed precision forward passes match the eager model.')
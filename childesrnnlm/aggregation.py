@@ -0,0 +1,104 @@
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from childesrnnlm.cache import write_atomically
+
+INDEX_FILE_NAME = 'index.parquet'
+
+
+def get_path2mtime(param_path: Path,
+                   ) -> Dict[str, float]:
+    """
+    return the modification time of each csv file of all jobs of one param setting, by path relative to param_path
+    """
+    return {str(p.relative_to(param_path)): p.stat().st_mtime for p in param_path.rglob('*.csv')}
+
+
+def update_index(param_path: Path,
+                 ) -> pd.DataFrame:
+    """
+    compact all metric series (csv files) of all jobs of one param setting into a single parquet file,
+    which has one row per (csv file, step), sorted by metric, so that reading a single metric is fast.
+
+    the update is incremental: only csv files that are new or modified since the last update are read.
+    """
+    index_path = param_path / INDEX_FILE_NAME
+    if index_path.exists():
+        df_old = pd.read_parquet(index_path)
+        path2mtime_old = dict(zip(df_old['path'], df_old['mtime']))
+    else:
+        df_old = None
+        path2mtime_old = {}
+
+    # find csv files that are new or modified
+    path2mtime = get_path2mtime(param_path)
+    paths_changed = [p for p, mtime in path2mtime.items() if path2mtime_old.get(p) != mtime]
+    if df_old is not None and not paths_changed and path2mtime_old.keys() == path2mtime.keys():
+        return df_old
+
+    dfs = []
+    if df_old is not None:
+        dfs.append(df_old[df_old['path'].isin(path2mtime.keys()) & ~df_old['path'].isin(paths_changed)])
+    for p in paths_changed:
+        s = pd.read_csv(param_path / p, index_col=0).iloc[:, 0]
+        dfs.append(pd.DataFrame({'path': p,
+                                 'mtime': path2mtime[p],
+                                 'metric': Path(p).stem,
+                                 'step': s.index.values,
+                                 'value': s.values}))
+    if not dfs:  # e.g. all jobs are still running
+        print(f'Did not find csv files in {param_path}. Index not updated.')
+        return pd.DataFrame(columns=['path', 'mtime', 'metric', 'step', 'value'])
+    df = pd.concat(dfs, ignore_index=True).sort_values(['metric', 'path', 'step'], ignore_index=True)
+
+    with write_atomically(index_path) as index_path_tmp:
+        df.to_parquet(index_path_tmp, index=False)
+    print(f'Updated index with {len(paths_changed)} new or modified csv files at {index_path}')
+
+    return df
+
+
+def aggregate_results(runs_path: Path,
+                      ) -> None:
+    """
+    update the index of every param setting under runs_path
+    """
+    for param_path in sorted(runs_path.glob('param_*')):
+        update_index(param_path)
+
+
+def is_index_stale(param_path: Path,
+                   ) -> bool:
+    """
+    return True if csv files were added, modified or removed since the index of param_path was last updated
+    """
+    df = pd.read_parquet(param_path / INDEX_FILE_NAME, columns=['path', 'mtime']).drop_duplicates('path')
+    return dict(zip(df['path'], df['mtime'])) != get_path2mtime(param_path)
+
+
+def load_series_from_index(param_path: Path,
+                           metric: str,
+                           ) -> Optional[List[pd.Series]]:
+    """
+    return all series of one metric across jobs of one param setting, or None if there is no index.
+    if the index is stale (e.g. more jobs completed since it was made), it is updated first,
+    and if it cannot be updated (e.g. the file server is read-only), None is returned.
+    """
+    index_path = param_path / INDEX_FILE_NAME
+    if not index_path.exists():
+        return None
+    if is_index_stale(param_path):
+        try:
+            update_index(param_path)
+        except OSError as e:
+            print(f'Could not update stale index at {index_path}: {e}')
+            return None
+
+    df = pd.read_parquet(index_path, columns=['path', 'step', 'value'], filters=[('metric', '==', metric)])
+    res = []
+    for path, df_path in df.groupby('path', sort=True):
+        s = pd.Series(df_path['value'].values, index=df_path['step'].values, name=metric)
+        res.append(s)
+    return res
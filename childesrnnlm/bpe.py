@@ -1,4 +1,5 @@
-from typing import List, Optional
+import numpy as np
+from typing import List, Optional, Tuple
 
 from tokenizers.implementations.byte_level_bpe import ByteLevelBPETokenizer, AddedToken
 
@@ -18,3 +19,31 @@ def train_bpe_tokenizer(sentences: List[str],
                                   special_tokens=[AddedToken(t, single_word=True) for t in special_tokens],
                                   )
     return tokenizer
+
+
+def tokenize_transcripts(tokenizer: ByteLevelBPETokenizer,
+                         transcripts: List[str],
+                         excluded_tokens: Optional[List[str]] = None,
+                         batch_size: int = 1024,
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    tokenize transcripts in parallel, using the batch encoding of the tokenizers library.
+
+    returns token ids of all transcripts concatenated, and offsets marking the start of each transcript,
+    without materializing a list of token strings.
+    """
+    excluded_ids = np.array([tokenizer.token_to_id(t) for t in excluded_tokens or []
+                             if tokenizer.token_to_id(t) is not None], dtype=np.int64)
+    dtype = np.uint16 if tokenizer.get_vocab_size() <= np.iinfo(np.uint16).max else np.int32
+
+    ids_list = []
+    for start in range(0, len(transcripts), batch_size):
+        encodings = tokenizer.encode_batch(transcripts[start:start + batch_size], add_special_tokens=True)
+        for encoding in encodings:
+            ids = np.array(encoding.ids, dtype=dtype)
+            ids_list.append(ids[~np.isin(ids, excluded_ids)])
+
+    offsets = np.zeros(len(ids_list) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in ids_list], out=offsets[1:])
+    token_ids = np.concatenate(ids_list) if ids_list else np.zeros(0, dtype=dtype)
+    return token_ids, offsets
@@ -0,0 +1,143 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+from typing import List, Optional, Tuple, Dict, Any, Iterator
+
+from tokenizers import Tokenizer
+
+from childesrnnlm import configs
+
+
+@contextlib.contextmanager
+def write_atomically(path: Path,
+                     ) -> Iterator[Path]:
+    """
+    yield a temporary path, unique to this process and thread, which replaces path once it has been written.
+    the temporary path keeps the suffix of path, because some writers (e.g. np.save) append a missing suffix.
+    """
+    # readers (e.g. concurrent jobs) never see a partially written file or directory
+    path_tmp = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{path.suffix}')
+    try:
+        yield path_tmp
+        os.replace(path_tmp, path)
+    finally:
+        if path_tmp.is_dir():
+            shutil.rmtree(path_tmp, ignore_errors=True)
+        elif path_tmp.exists():
+            path_tmp.unlink()
+
+
+def make_corpus_cache_key(corpus_name: str,
+                          num_types: int,
+                          probes: List[str],
+                          lowercase: bool,
+                          ) -> str:
+    """
+    make a key that identifies a tokenized corpus.
+
+    the order of transcripts is not part of the key, because B-BPE training does not depend on it,
+    and shuffling is performed at the transcript level after loading from cache.
+    """
+    data = {'corpus': corpus_name,
+            'num_types': num_types,
+            'probes': sorted(probes),
+            'lowercase': lowercase,
+            }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def save_tokenized_corpus(key: str,
+                          tokenizer: Tokenizer,
+                          token_ids: np.ndarray,
+                          offsets: np.ndarray,
+                          info: Dict[str, Any],
+                          ) -> None:
+    """
+    save tokenizer, token ids and transcript offsets to cache.
+    """
+    path = configs.Dirs.cache / key
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with write_atomically(path) as path_tmp:
+            path_tmp.mkdir()
+            tokenizer.save(str(path_tmp / 'tokenizer.json'))
+            np.save(path_tmp / 'token_ids.npy', token_ids)
+            np.save(path_tmp / 'offsets.npy', offsets)
+            with (path_tmp / 'info.json').open('w') as f:
+                json.dump(info, f)
+    except OSError:
+        if not path.exists():
+            raise
+        return  # another job saved the same entry first
+    print(f'Saved tokenized corpus to {path}', flush=True)
+
+
+def load_tokenized_corpus(key: str,
+                          ) -> Optional[Tuple[Tokenizer, np.ndarray, np.ndarray, Dict[str, Any]]]:
+    """
+    load tokenizer, memory-mapped token ids, transcript offsets and info from cache.
+    return None if the corpus has not been cached.
+    """
+    path = configs.Dirs.cache / key
+    if not path.exists():
+        return None
+
+    print(f'Loading tokenized corpus from {path}', flush=True)
+    tokenizer = Tokenizer.from_file(str(path / 'tokenizer.json'))
+    token_ids = np.load(path / 'token_ids.npy', mmap_mode='r')
+    offsets = np.load(path / 'offsets.npy')
+    with (path / 'info.json').open('r') as f:
+        info = json.load(f)
+
+    return tokenizer, token_ids, offsets, info
+
+
+def make_windows_cache_key(token_ids: np.ndarray,
+                           **prep_kwargs,
+                           ) -> str:
+    """
+    make a key that identifies the windows made by Prep from token_ids, with the arguments prep_kwargs.
+    the token ids are part of the key, because their order differs between jobs if transcripts are shuffled.
+    """
+    h = hashlib.sha1(np.ascontiguousarray(token_ids).view(np.uint8))
+    h.update(json.dumps(prep_kwargs, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def save_windows(key: str,
+                 windows: np.ndarray,
+                 ) -> None:
+    """
+    save windows to cache, with the smallest integer type that can hold all token ids.
+    """
+    path = configs.Dirs.cache / 'windows' / f'{key}.npy'
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    dtype = np.uint16 if windows.max() < np.iinfo(np.uint16).max else np.int32
+    with write_atomically(path) as path_tmp:
+        np.save(path_tmp, windows.astype(dtype, copy=False))
+    print(f'Saved {len(windows):,} windows to {path}', flush=True)
+
+
+def load_windows(key: str,
+                 ) -> Optional[np.ndarray]:
+    """
+    load read-only memory-mapped windows from cache, which are shared between all jobs on the same machine.
+    return None if the windows have not been cached.
+    """
+    path = configs.Dirs.cache / 'windows' / f'{key}.npy'
+    if not path.exists():
+        return None
+
+    print(f'Loading windows from {path}', flush=True)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,79 @@
+import random
+import numpy as np
+import torch
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+from childesrnnlm.cache import write_atomically
+from childesrnnlm.rnn import RNN, Hidden
+
+
+def save_checkpoint(path: Path,
+                    models: List[RNN],
+                    optimizers: List[torch.optim.Optimizer],
+                    step: int,
+                    performances: List[Dict[str, List[float]]],
+                    eval_steps: List[int],
+                    hiddens: List[Optional[Hidden]],
+                    ) -> None:
+    """
+    save everything needed to resume training of all replicas after step.
+    hiddens are the hidden states carried into the next mini-batch when training with truncated bptt.
+
+    a job that is preempted while saving never leaves a corrupted checkpoint behind.
+    only plain containers and tensors are saved, so that the checkpoint can be loaded with weights_only=True.
+    """
+    np_state = np.random.get_state()
+    checkpoint = {
+        'step': step,
+        'models': [model.state_dict() for model in models],
+        'optimizers': [optimizer.state_dict() for optimizer in optimizers],
+        'performances': [{k: [float(vi) for vi in v] for k, v in performance.items()}
+                         for performance in performances],
+        'eval_steps': [int(s) for s in eval_steps],
+        'hiddens': hiddens,
+        'random_state': random.getstate(),
+        'np_random_state': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), *np_state[2:]),
+        'torch_random_state': torch.get_rng_state(),
+        'cuda_random_state': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with write_atomically(path) as path_tmp:
+        torch.save(checkpoint, path_tmp)
+    print(f'Saved checkpoint at step={step:,}', flush=True)
+
+
+def load_checkpoint(path: Path,
+                    models: List[RNN],
+                    optimizers: List[torch.optim.Optimizer],
+                    ) -> Optional[Dict[str, Any]]:
+    """
+    restore models, optimizers and random states from checkpoint, in-place.
+    return the checkpoint, or None if there is no checkpoint to resume from.
+    """
+    if not path.exists():
+        return None
+
+    checkpoint = torch.load(path, map_location=models[0].device)
+    if len(checkpoint['models']) != len(models):
+        raise RuntimeError(f'Checkpoint has {len(checkpoint["models"])} replicas but job has {len(models)}.')
+    if len(checkpoint['optimizers']) != len(optimizers):  # e.g. replicas were trained as one batched model
+        raise RuntimeError(f'Checkpoint has {len(checkpoint["optimizers"])} optimizers but job has {len(optimizers)}.')
+    # hidden states are saved for each optimizer, i.e. for each replica, or once for replicas trained as one model.
+    # checkpoints saved before hidden states were saved resume with zero hidden states
+    checkpoint.setdefault('hiddens', [None] * len(optimizers))
+    for model, state_dict in zip(models, checkpoint['models']):
+        model.load_state_dict(state_dict)
+    for optimizer, state_dict in zip(optimizers, checkpoint['optimizers']):
+        optimizer.load_state_dict(state_dict)
+
+    np_state = checkpoint['np_random_state']
+    random.setstate(checkpoint['random_state'])
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), *np_state[2:]))
+    torch.set_rng_state(checkpoint['torch_random_state'])
+    if checkpoint['cuda_random_state'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint['cuda_random_state'])
+
+    print(f'Resuming from checkpoint at step={checkpoint["step"]:,}', flush=True)
+    return checkpoint
@@ -6,6 +6,32 @@ class Dirs:
     src = Path(__file__).parent
     corpora = root / 'data' / 'corpora'
     structures = root / 'data' / 'structures'
+    cache = root / 'data' / 'cache'  # tokenized corpora, shared by jobs on the same machine
+
+
+class Device:
+    use_gpu = True  # falls back to cpu if no gpu is available
+    num_cpu_threads = None  # number of intra-op threads on cpu, defaults to all cores available to the job
+    compile = False  # compile forward pass with torch.compile, or with TorchScript if torch.compile is not available
+    autocast_bf16 = False  # run forward passes in bfloat16 mixed precision, requires torch>=1.10
+
+
+class Pipeline:
+    prefetch_depth = 8  # number of mini-batches prepared in the background, ahead of training
+
+
+class Checkpoint:
+    enabled = True  # resume interrupted jobs from the last checkpoint in the job's save_path
+    num_steps = 20_000  # number of mini-batches between checkpoints
+
+
+class Profile:
+    enabled = False  # time each phase of training and evaluation, and save a report to the job's save_path
+
+
+class Replicas:
+    batched = True  # train srn replicas as one model with stacked weights, in a single forward and backward pass
+    batched_on_cpu = False  # on cpu, batched matrix products are slower than separate ones, except for small models
 
 
 class Start:
@@ -14,11 +40,16 @@ class Start:
 
 
 class Eval:
-    train_pp = False  # extremely slow if True
+    train_pp = True
+    train_pp_max_num_mbs = 512  # evaluate train pp on an evenly spaced subsample of mini-batches
+    pp_batch_size = 4096  # number of windows per forward pass when computing perplexity
     structures = ['sem-2021']
     num_steps_to_eval = 50_000
+    asynchronous = False  # evaluate a snapshot of the model in a background thread while training continues
+    max_num_pending_evals = 1  # training waits if more snapshots than this are queued for evaluation
     min_num_test_tokens = 0
-    cs_max_rows = 128
+    cs_max_rows = 128  # max number of exemplars per category used to compute category spread
+    cs_block_size = 16  # number of exemplars whose divergences to all other exemplars are computed at once
 
     ba_o = True
     ba_n = True
@@ -28,6 +59,7 @@ class Eval:
     sd_n = True
 
     max_num_exemplars = 8192  # keep this as large as possible to reproduce age-order effect
+    representation_batch_size = 4096  # number of windows per forward pass when making representations
 
 
 class Figs:
@@ -0,0 +1,40 @@
+import contextlib
+import os
+import torch
+
+from childesrnnlm import configs
+
+
+def get_device() -> torch.device:
+    """
+    return gpu if available and requested, otherwise cpu.
+
+    on cpu, the number of intra-op threads is set explicitly,
+    because the torch default does not respect the cores actually allotted to a job on a shared node.
+    """
+    if configs.Device.autocast_bf16 and not hasattr(torch, 'autocast'):
+        print('torch.autocast is not available (torch < 1.10). Using float32.', flush=True)
+
+    if configs.Device.use_gpu and torch.cuda.is_available():
+        return torch.device('cuda')
+
+    if configs.Device.num_cpu_threads is not None:
+        num_threads = configs.Device.num_cpu_threads
+    elif hasattr(os, 'sched_getaffinity'):
+        num_threads = len(os.sched_getaffinity(0))
+    else:
+        num_threads = os.cpu_count()
+    torch.set_num_threads(num_threads)
+    print(f'Using cpu with {num_threads} threads', flush=True)
+
+    return torch.device('cpu')
+
+
+def autocast(device: torch.device):
+    """
+    return a context in which forward passes run in bfloat16 mixed precision, if requested.
+    """
+    if configs.Device.autocast_bf16 and hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    else:
+        return contextlib.nullcontext()
@@ -0,0 +1,45 @@
+import numpy as np
+from typing import Optional
+
+
+def calc_js_divergences(ps: np.ndarray,
+                        q: np.ndarray,
+                        ) -> np.ndarray:
+    """
+    compute Jensen-Shannon divergence (base 2, bounded by 1) between each row in ps and q, in one vectorized operation.
+
+    ps has shape [num_rows, num_types], and q has shape [num_types] or [num_rows, num_types].
+    """
+    q = np.broadcast_to(q, ps.shape)
+    m = (ps + q) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kl_pm = np.where(ps > 0, ps * np.log2(ps / m), 0.0).sum(axis=1)
+        kl_qm = np.where(q > 0, q * np.log2(q / m), 0.0).sum(axis=1)
+    return (kl_pm + kl_qm) / 2
+
+
+def calc_spread(ps: np.ndarray,
+                max_rows: Optional[int] = None,
+                block_size: int = 16,
+                ) -> float:
+    """
+    compute the mean Jensen-Shannon divergence between all pairs of distinct rows in ps.
+
+    to bound memory, divergences are computed for blocks of rows at a time, against all other rows.
+    to bound computation, at most max_rows rows are randomly selected without replacement.
+    """
+    if max_rows is not None and len(ps) > max_rows:
+        ps = ps[np.random.choice(len(ps), size=max_rows, replace=False)]
+    num_rows, num_types = ps.shape
+    if num_rows < 2:
+        return np.nan
+
+    total = 0.0
+    for start in range(0, num_rows, block_size):
+        block = ps[start:start + block_size]
+        pairs_left = np.broadcast_to(block[:, np.newaxis], (len(block), num_rows, num_types))
+        pairs_right = np.broadcast_to(ps[np.newaxis], (len(block), num_rows, num_types))
+        divergences = calc_js_divergences(pairs_left.reshape(-1, num_types), pairs_right.reshape(-1, num_types))
+        total += divergences.sum()  # divergence of a row with itself is zero
+
+    return total / (num_rows * (num_rows - 1))
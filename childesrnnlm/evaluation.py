@@ -1,77 +1,99 @@
-import pyprind
+import weakref
 import torch
 import numpy as np
 
-from typing import List, Union, Dict
-from sklearn.metrics.pairwise import cosine_similarity
-from torch.nn import CrossEntropyLoss
+from itertools import islice
+from typing import List, Union, Dict, Optional
+from torch.nn.functional import cross_entropy
 
 from categoryeval.ba import BAScorer
-from categoryeval.dp import DPScorer
-from categoryeval.cs import CSScorer
 from categoryeval.si import SIScorer
 from categoryeval.sd import SDScorer
 
 from preppy import Prep
 
 from childesrnnlm import configs
+from childesrnnlm.device import autocast
 from childesrnnlm.rnn import RNN
-from childesrnnlm.representation import make_representations_without_context
-from childesrnnlm.representation import make_representations_with_context
-from childesrnnlm.representation import make_output_representations
+from childesrnnlm.representation import RepresentationCache
+from childesrnnlm.windows import get_window_store
 from childesrnnlm.io import load_probe2cat
+from childesrnnlm.metrics import MetricsWriter
+from childesrnnlm.profiling import Profiler
+from childesrnnlm.divergence import calc_js_divergences, calc_spread
+
+# made once per job
+prep2token_ids = weakref.WeakKeyDictionary()
+prep2structure2prototype = weakref.WeakKeyDictionary()
 
 
 def calc_perplexity(model: RNN,
-                    criterion: CrossEntropyLoss,
                     prep: Prep,
                     is_test: bool,
-                    ):
-    print(f'Calculating perplexity...')
-
-    pp_sum = 0
-    num_batches = 0
-    pbar = pyprind.ProgBar(prep.num_mbs, stream=1)
-
-    for windows in prep.generate_batches(is_test=is_test):
-
-        # to tensor
-        x, y = np.split(windows, [prep.context_size], axis=1)
-        inputs = torch.cuda.LongTensor(x)
-        targets = torch.cuda.LongTensor(np.squeeze(y))
-
-        # calc pp (using torch only, on GPU)
-        logits = model(inputs)['logits']  # initial hidden state defaults to zero if not provided
-        loss_batch = criterion(logits, targets).detach()  # detach to prevent saving complete graph for every sample
-        pp_batch = torch.exp(loss_batch)  # need base e
+                    max_num_mbs: Optional[int] = None,
+                    ) -> float:
+    """
+    compute corpus perplexity, exp of the mean negative log-likelihood over all target tokens.
 
-        pbar.update()
+    to reduce the number of forward passes, mini-batches are concatenated into larger evaluation batches,
+    and the summed loss is accumulated on device, so that there is only a single synchronization with the host.
+    if max_num_mbs is given, a deterministic subsample of at most max_num_mbs evenly spaced mini-batches is evaluated.
+    """
+    print(f'Calculating perplexity...')
 
-        pp_sum += pp_batch.detach().cpu().numpy()
-        num_batches += 1
-    pp = pp_sum / num_batches
+    if is_test:
+        batch_generator = prep.generate_batches(is_test=True)
+    else:
+        window_store = get_window_store(prep)
+        if max_num_mbs is not None and window_store.num_mbs > max_num_mbs:
+            mb_ids = np.linspace(0, window_store.num_mbs - 1, max_num_mbs).astype(int)
+        else:
+            mb_ids = None
+        batch_generator = window_store.generate_batches(mb_ids)
+    num_mbs_per_eval_batch = max(1, configs.Eval.pp_batch_size // prep.batch_size)
+
+    nll_sum = torch.zeros(1, device=model.device)
+    num_targets = 0
+    with torch.no_grad():
+        while True:
+            windows_list = list(islice(batch_generator, num_mbs_per_eval_batch))
+            if not windows_list:
+                break
+            windows = np.vstack(windows_list)
+
+            # to tensor
+            x, y = np.split(windows.astype(np.int64), [prep.context_size], axis=1)
+            inputs = torch.tensor(x, device=model.device)
+            targets = torch.tensor(y.reshape(-1), device=model.device)
+
+            # sum loss over targets (using torch only, on device)
+            with autocast(model.device):
+                logits = model(inputs)['logits'].view(-1, prep.num_types)
+            nll_sum += cross_entropy(logits.float(), targets, reduction='sum')
+            num_targets += len(targets)
+
+    pp = torch.exp(nll_sum / num_targets).item()  # need base e
     return pp
 
 
 def update_pp_performance(performance,
                           model: RNN,
-                          criterion: CrossEntropyLoss,
                           prep: Prep,
                           ):
     if configs.Eval.train_pp:
-        train_pp = calc_perplexity(model, criterion, prep, is_test=False)
+        train_pp = calc_perplexity(model, prep, is_test=False, max_num_mbs=configs.Eval.train_pp_max_num_mbs)
         performance['train_pp'].append(train_pp)
     if configs.Eval.min_num_test_tokens > 0:
-        test_pp = calc_perplexity(model, criterion, prep, is_test=True)
+        test_pp = calc_perplexity(model, prep, is_test=True)
         performance['test_pp'].append(test_pp)
 
     return performance
 
 
 def update_ba_performance(performance,
-                          model: RNN,
                           prep: Prep,
                           structure2probe2cat: Dict[str, Dict[str, str]],
+                          rep_cache: RepresentationCache,
                           ):
     for structure_name in configs.Eval.structures:
         probe2cat = structure2probe2cat[structure_name]
@@ -80,14 +102,12 @@ def update_ba_performance(performance,
         probe_store = ba_scorer.probe_store
         probe_token_ids = [prep.token2id[token] for token in probe_store.types]
 
-        probe_reps_o = make_representations_with_context(model, probe_token_ids, prep)
-        probe_reps_n = make_representations_without_context(model, probe_token_ids)
+        # similarities are computed once per eval step for all probes, and shared across structures
+        probe_sims_o = rep_cache.get_sims('o', probe_token_ids)
+        probe_sims_n = rep_cache.get_sims('n', probe_token_ids)
 
-        assert len(probe_reps_o) > 0
-        assert len(probe_reps_n) > 0
-
-        probe_sims_o = cosine_similarity(probe_reps_o)
-        probe_sims_n = cosine_similarity(probe_reps_n)
+        assert len(probe_sims_o) > 0
+        assert len(probe_sims_n) > 0
 
         if configs.Eval.ba_n:
             performance.setdefault(f'ba_n_{structure_name}', []).append(
@@ -99,75 +119,98 @@ def update_ba_performance(performance,
     return performance
 
 
+def make_prototype(prep: Prep,
+                   probes: List[str],
+                   ) -> np.ndarray:
+    """
+    make the prototype of a category, the distribution over next words following any probe in the corpus
+    """
+    token_ids = get_token_ids(prep)
+    probe_ids = [prep.token2id[p] for p in probes]
+    is_probe = np.isin(token_ids[:-1], probe_ids)
+    next_ids = token_ids[1:][is_probe]
+    f = np.bincount(next_ids, minlength=prep.num_types).astype(np.float64)
+    return f / f.sum()
+
+
+def get_token_ids(prep: Prep,
+                  ) -> np.ndarray:
+    """
+    return ids of all tokens in prep, which are made only once per job
+    """
+    if prep not in prep2token_ids:
+        prep2token_ids[prep] = np.array([prep.token2id[t] for t in prep.tokens], dtype=np.int64)
+    return prep2token_ids[prep]
+
+
 def update_dp_performance(performance,
-                          model: RNN,
                           prep: Prep,
                           structure2probe2cat: Dict[str, Dict[str, str]],
+                          rep_cache: RepresentationCache,
                           ):
     """
     calculate distance-to-prototype (aka dp):
     a home-made quantity that is proportional to the distance of same-category probe representations
     to a location in representational space that can be thought of as the category's "prototype",
     obtained by leveraging all of the co-occurrence data in a corpus.
+
+    prototypes are computed once per job, and divergences of all probes are computed in one matrix operation.
     """
     for structure_name in configs.Eval.structures:
-        probe2cat = structure2probe2cat[structure_name]
-        dp_scorer = DPScorer(probe2cat, prep.tokens)
+        probes = sorted(structure2probe2cat[structure_name])
 
-        # collect dp for probes who tend to occur most frequently in some part of corpus
-        probes = dp_scorer.probe_store.types
-        qs = make_output_representations(model, probes, prep)
-
-        # check predictions
-        max_ids = np.argsort(qs.mean(axis=0))
-        print(f'{structure_name} predict:', [prep.types[i] for i in max_ids[-10:]])
+        structure2prototype = prep2structure2prototype.setdefault(prep, {})
+        if structure_name not in structure2prototype:
+            structure2prototype[structure_name] = make_prototype(prep, probes)
+        prototype = structure2prototype[structure_name]
 
         # dp
-        dp = dp_scorer.calc_dp(qs, return_mean=True, metric='js')
+        qs = np.exp(rep_cache.get('output', [prep.token2id[p] for p in probes]))
+        dp = calc_js_divergences(qs, prototype).mean()
         performance.setdefault(f'dp_{structure_name}_js', []).append(dp)
 
     return performance
 
 
 def update_cs_performance(performance,
-                          model: RNN,
                           prep: Prep,
                           structure2probe2cat: Dict[str, Dict[str, str]],
+                          rep_cache: RepresentationCache,
                           ):
     """
     compute category-spread.
     a home-made quantity that is proportional to the spread between probe representations.
 
-    to speed computation, we compute spread only within each category, and return the mean across categories.
+    to speed computation, we compute spread only within each category, and return the mean across categories
+    with at least two exemplars.
+    output representations of all probes in a structure are made at once, and then sliced by category.
     """
-    exemplars_list = []
     for structure_name in configs.Eval.structures:
         probe2cat = structure2probe2cat[structure_name]
-        cs_scorer = CSScorer(probe2cat)
-
-        # compute cs for each category
-        cs_total = 0
-        for cat in cs_scorer.probe_store.cats:
-            # collect output representations for probes in same category
-            exemplars = make_output_representations(model, cs_scorer.probe_store.cat2probes[cat], prep)
-            exemplars_list.append(exemplars)
-            ps = np.vstack(exemplars_list)
-            print(f'Input to computation of cs has shape={ps.shape}', flush=True)
+        probes = sorted(probe2cat)
+        qs = np.exp(rep_cache.get('output', [prep.token2id[p] for p in probes]))
+
+        # compute cs for each category - spread is undefined for categories with a single exemplar, which are skipped
+        cats = sorted(set(probe2cat.values()))
+        cs_cats = []
+        for cat in cats:
             # compute divergences between exemplars within a category
-            cs_cat = cs_scorer.calc_cs(ps, ps, metric='js', max_rows=configs.Eval.cs_max_rows)
-            print(f'category spread for cat={cat:<18} ={cs_cat:.4f}', flush=True)
-            cs_total += cs_cat
+            exemplars = qs[[n for n, p in enumerate(probes) if probe2cat[p] == cat]]
+            if len(exemplars) < 2:
+                continue
+            cs_cat = calc_spread(exemplars, max_rows=configs.Eval.cs_max_rows, block_size=configs.Eval.cs_block_size)
+            cs_cats.append(cs_cat)
 
-        cs = cs_total / len(cs_scorer.probe_store.cats)
+        cs = np.mean(cs_cats) if cs_cats else np.nan
         performance.setdefault(f'cs_{structure_name}_js', []).append(cs)
 
     return performance
 
 
 def update_si_performance(performance,
-                          model: RNN,
                           prep: Prep,
                           structure2probe2cat: Dict[str, Dict[str, str]],
+                          rep_cache: RepresentationCache,
                           ):
     """
     compute silhouette scores.
@@ -178,8 +221,8 @@ def update_si_performance(performance,
         si_scorer = SIScorer(probe2cat)
 
         probe_token_ids = [prep.token2id[token] for token in si_scorer.probe_store.types]
-        probe_reps_n = make_representations_without_context(model, probe_token_ids)
-        probe_reps_o = make_representations_with_context(model, probe_token_ids, prep)
+        probe_reps_n = rep_cache.get('n', probe_token_ids)
+        probe_reps_o = rep_cache.get('o', probe_token_ids)
         cat_ids = [si_scorer.probe_store.cat2id[si_scorer.probe_store.probe2cat[p]]
                    for p in si_scorer.probe_store.types]
 
@@ -195,9 +238,9 @@ def update_si_performance(performance,
 
 
 def update_sd_performance(performance,
-                          model: RNN,
                           prep: Prep,
                           structure2probe2cat: Dict[str, Dict[str, str]],
+                          rep_cache: RepresentationCache,
                           ):
     """
     compute S-Dbw score.
@@ -209,8 +252,8 @@ def update_sd_performance(performance,
 
         probe_token_ids = [prep.token2id[token] for token in sd_scorer.probe_store.types]
 
-        probe_reps_n = make_representations_without_context(model, probe_token_ids)
-        probe_reps_o = make_representations_with_context(model, probe_token_ids, prep)
+        probe_reps_n = rep_cache.get('n', probe_token_ids)
+        probe_reps_o = rep_cache.get('o', probe_token_ids)
         cat_ids = [sd_scorer.probe_store.cat2id[sd_scorer.probe_store.probe2cat[p]]
                    for p in sd_scorer.probe_store.types]
 
@@ -225,6 +268,64 @@ def update_sd_performance(performance,
     return performance
 
 
+def update_performance(performance,
+                       model: RNN,
+                       prep: Prep,
+                       structure2probe2cat: Dict[str, Dict[str, str]],
+                       step: int,
+                       metrics_writer: Optional[MetricsWriter] = None,
+                       profiler: Optional[Profiler] = None,
+                       ):
+    """
+    run all scorers at a single eval step, and optionally stream the results to metrics_writer.
+    does not modify model, so it can be called with a snapshot of the model in a background thread.
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False, device=model.device)
+
+    with profiler.time('eval_pp'):
+        performance = update_pp_performance(performance, model, prep)
+
+    # representations are shared by scorers and structures, and computed at most once per eval step,
+    # so the time to compute them is attributed to the first scorer that needs them
+    probe_token_ids = [prep.token2id[probe]
+                       for probe2cat in structure2probe2cat.values() for probe in probe2cat]
+    rep_cache = RepresentationCache(model, prep, step, probe_token_ids)
+    with profiler.time('eval_ba'):
+        performance = update_ba_performance(performance, prep, structure2probe2cat, rep_cache)
+    with profiler.time('eval_cs'):
+        performance = update_cs_performance(performance, prep, structure2probe2cat, rep_cache)
+    with profiler.time('eval_dp'):
+        performance = update_dp_performance(performance, prep, structure2probe2cat, rep_cache)
+    with profiler.time('eval_si'):
+        performance = update_si_performance(performance, prep, structure2probe2cat, rep_cache)
+    with profiler.time('eval_sd'):
+        performance = update_sd_performance(performance, prep, structure2probe2cat, rep_cache)
+
+    print(f'performance at step={step:,}')
+    for k, v in performance.items():
+        if not v:
+            continue
+        print(f'{k: <12}={v[-1]:.2f}')
+    print(flush=True)
+
+    if metrics_writer is not None:
+        metrics_writer.write(step, {k: v[-1] for k, v in performance.items() if v})
+
+    return performance
+
+
+def merge_performance(performance,
+                      performance_step,
+                      ):
+    """
+    append performance computed at a single eval step (e.g. in a background thread) to performance
+    """
+    for k, v in performance_step.items():
+        performance.setdefault(k, []).extend(v)
+    return performance
+
+
 def get_weights(model):
     ih = model.rnn.weight_ih_l  # [hidden_size, input_size]
     hh = model.rnn.weight_hh_l  # [hidden_size, hidden_size]
@@ -1,39 +1,81 @@
+import copy
 import time
 import pyprind
 import pandas as pd
 import numpy as np
 import torch
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
 from pathlib import Path
-from itertools import chain
-from typing import List
+from itertools import chain, islice
+from typing import List, Tuple, Dict, Any, Optional
 import random
+import zlib
 
 from aochildes.dataset import ChildesDataSet
 from aonewsela.dataset import NewselaDataSet
 from preppy import Prep
+from tokenizers import Tokenizer
 from entropicstart.editor import Editor
 
 from childesrnnlm import configs
-from childesrnnlm.bpe import train_bpe_tokenizer
+from childesrnnlm.bpe import train_bpe_tokenizer, tokenize_transcripts
+from childesrnnlm.checkpoint import save_checkpoint, load_checkpoint
+from childesrnnlm.cache import make_corpus_cache_key, load_tokenized_corpus, save_tokenized_corpus
+from childesrnnlm.cache import make_windows_cache_key
+from childesrnnlm.device import get_device
 from childesrnnlm.io import load_probe2cat
-from childesrnnlm.evaluation import update_ba_performance
-from childesrnnlm.evaluation import update_pp_performance
-from childesrnnlm.evaluation import update_dp_performance
-from childesrnnlm.evaluation import update_cs_performance
-from childesrnnlm.evaluation import update_si_performance
-from childesrnnlm.evaluation import update_sd_performance
+from childesrnnlm.evaluation import update_performance
+from childesrnnlm.evaluation import merge_performance
+from childesrnnlm.metrics import MetricsWriter
 from childesrnnlm.params import Params
-from childesrnnlm.rnn import RNN
+from childesrnnlm.pipeline import BatchPrefetcher, StatefulBatcher
+from childesrnnlm.profiling import Profiler
+from childesrnnlm.rnn import RNN, Hidden, StackedSRN, compile_model
+from childesrnnlm.training import make_optimizer, train_step, train_stacked_step
+from childesrnnlm.windows import make_window_store, get_window_store
 
 
-def main(param2val):
-    # params
-    params = Params.from_param2val(param2val)
-    print(params)
+@dataclass
+class Replica:
+    """
+    a model with its own optimizer and performance, trained in lockstep with other replicas
+    """
+    model: RNN
+    forward_model: torch.nn.Module
+    optimizer: Optional[torch.optim.Optimizer]  # None if replicas are trained as one batched model
+    metrics_writer: MetricsWriter
+    performance: Dict[str, List[float]] = field(default_factory=lambda: {'train_pp': [], 'test_pp': []})
+    pending_evals: List[Future] = field(default_factory=list)
+    hidden: Optional[Hidden] = None  # carried across mini-batches, if training with truncated backprop-through-time
 
-    project_path = Path(param2val['project_path'])
 
+def make_series(performance: Dict[str, List[float]],
+                eval_steps: List[int],
+                ) -> List[pd.Series]:
+    """
+    collect performance in list of pandas series
+    """
+    res = []
+    for k, v in performance.items():
+        if not v:
+            continue
+        transcript = pd.Series(v, index=eval_steps)
+        transcript.name = k
+        res.append(transcript)
+    return res
+
+
+def tokenize_corpus(project_path: Path,
+                    params: Params,
+                    ) -> Tuple[Tokenizer, np.ndarray, np.ndarray, Dict[str, Any]]:
+    """
+    load transcripts, train B-BPE tokenizer, and tokenize all transcripts.
+
+    returns the tokenizer, token ids of all transcripts concatenated,
+    offsets marking the start of each transcript in the token ids, and information needed by main().
+    """
     # load corpus
     if params.corpus == 'aochildes':
         transcripts = ChildesDataSet().load_transcripts()
@@ -42,18 +84,17 @@ def main(param2val):
     else:
         raise AttributeError('Invalid corpus')
 
-    # shuffle at transcript level
-    if params.shuffle_transcripts:
-        random.shuffle(transcripts)
-
     text_original = ' '.join(transcripts)
     tokens_original = text_original.split()
     print(f'Loaded {len(tokens_original):,} words.')
 
+    # count words once, instead of scanning the list of words for every probe
+    word2f_original = Counter(tokens_original)
+
     # collect all probes, they should be treated as whole words by tokenizer
     probes_in_data = set()
     num_total = 0
-    types_in_sentences = set(tokens_original)
+    types_in_sentences = word2f_original.keys()
     for structure in configs.Eval.structures:
         probe2cat = load_probe2cat(project_path, structure, params.corpus)
         num_total += len(probe2cat)
@@ -70,28 +111,63 @@ def main(param2val):
     # tokenize text
     tokenizer = train_bpe_tokenizer(transcripts, params.num_types, special_tokens=special_tokens)
     print(f'Tokenizing {len(transcripts)} transcripts..', flush=True)
-    tokens = []
-    for transcript in transcripts:
-        if tokenizer is not None:
-            tmp: List[str] = [t for t in tokenizer.encode(transcript,
-                                                          add_special_tokens=True).tokens
-                              if t not in {'Ġ', '', ' '}]
-        else:
-            tmp: List[str] = transcript.split()
-        tokens.extend(tmp)
-    print(f'{len(set(tokens)):,} types in tokenized text', flush=True)
-    print(f'Added {len(tokens) - len(tokens_original):,} tokens during tokenization')
+    token_ids, offsets = tokenize_transcripts(tokenizer, transcripts, excluded_tokens=['Ġ', '', ' '])
 
     # check that added tokens were not split during tokenization
     num_errors = 0
+    id2f = np.bincount(token_ids, minlength=tokenizer.get_vocab_size())
     for special_t in special_tokens:
-        if special_t not in tokens and special_t in tokens_original:
-            print(f'"{special_t:<24}" occurs {tokens_original.count(special_t)} times in original text '
+        special_id = tokenizer.token_to_id(special_t)
+        if (special_id is None or id2f[special_id] == 0) and word2f_original[special_t] > 0:
+            print(f'"{special_t:<24}" occurs {word2f_original[special_t]} times in original text '
                   f'but not in tokenized text.')
             num_errors += 1
     if num_errors:
         raise RuntimeError(f'{num_errors} special tokens were not found in tokenized text.')
 
+    info = {'special_tokens': special_tokens,
+            'num_tokens_original': len(tokens_original),
+            }
+    return tokenizer, token_ids, offsets, info
+
+
+def main(param2val):
+    # params
+    params = Params.from_param2val(param2val)
+    print(params)
+
+    project_path = Path(param2val['project_path'])
+    save_path = Path(param2val['save_path'])
+
+    # collect all probes, which determine the special tokens of the tokenizer
+    probes = set()
+    for structure in configs.Eval.structures:
+        probes.update(load_probe2cat(project_path, structure, params.corpus).keys())
+
+    # load tokenized corpus from cache, which is shared by all jobs with the same corpus, vocab size, and probes
+    cache_key = make_corpus_cache_key(params.corpus, params.num_types, list(probes), lowercase=True)
+    cached = load_tokenized_corpus(cache_key)
+    if cached is None:
+        tokenizer, token_ids, offsets, info = tokenize_corpus(project_path, params)
+        save_tokenized_corpus(cache_key, tokenizer, token_ids, offsets, info)
+    else:
+        tokenizer, token_ids, offsets, info = cached
+    special_tokens = info['special_tokens']
+    probes_in_data = set(special_tokens)
+
+    # shuffle at transcript level - the order is seeded by the job's save_path, which is unique to each job,
+    # so that a job resumed from a checkpoint is trained on the same order as before it was interrupted
+    transcript_ids = list(range(len(offsets) - 1))
+    if params.shuffle_transcripts:
+        random.Random(zlib.crc32(str(save_path).encode())).shuffle(transcript_ids)
+        token_ids = np.concatenate([token_ids[offsets[i]:offsets[i + 1]] for i in transcript_ids])
+
+    # Prep requires token strings - the list is built directly from the ids, without an intermediate object array
+    id2token = [tokenizer.id_to_token(i) for i in range(tokenizer.get_vocab_size())]
+    tokens: List[str] = [id2token[i] for i in token_ids]
+    print(f'{len(set(tokens)):,} types in tokenized text', flush=True)
+    print(f'Added {len(tokens) - info["num_tokens_original"]:,} tokens during tokenization')
+
     # prepare data for batching
     prep = Prep(tokens,
                 reverse=params.reverse,
@@ -105,6 +181,23 @@ def main(param2val):
                 disallow_non_ascii=False,
                 )
 
+    # training windows are stored once per machine in a compact memory-mapped file, shared read-only by all jobs,
+    # and used for training and evaluation in place of the in-memory windows of prep.
+    # windows of shuffled transcripts are unique to each job, and would only fill the cache, so they stay in memory
+    if params.shuffle_transcripts:
+        window_store = get_window_store(prep)
+    else:
+        windows_key = make_windows_cache_key(token_ids,
+                                             reverse=params.reverse,
+                                             sliding=params.sliding,
+                                             num_parts=params.num_parts,
+                                             num_iterations=params.num_iterations,
+                                             batch_size=params.batch_size,
+                                             context_size=params.context_size,
+                                             min_num_test_tokens=configs.Eval.min_num_test_tokens,
+                                             )
+        window_store = make_window_store(prep, windows_key)
+
     # prepare artificially generated start sequences for batching
     if params.start != 'none':
         print(f'Adding {params.start} start', flush=True)
@@ -127,27 +220,52 @@ def main(param2val):
         prep_start = None
         print(f'Not adding start.')
 
+    # with truncated backprop-through-time, regular sequences are batched as contiguous streams,
+    # so that hidden state can be carried across consecutive mini-batches
+    if params.truncated_bptt:
+        batcher = StatefulBatcher(np.array([prep.token2id[t] for t in prep.tokens_train]),
+                                  batch_size=params.batch_size,
+                                  context_size=params.context_size,
+                                  num_parts=params.num_parts,
+                                  num_iterations=params.num_iterations,
+                                  reverse=params.reverse,
+                                  )
+        print(f'Truncated backprop-through-time over {batcher.num_mbs} batches '
+              f'instead of {prep.num_mbs} batches of windows')
+    else:
+        batcher = window_store
+
     # combine start sequences and regular sequences
     if prep_start:
-        batch_generator = chain(prep_start.generate_batches(), prep.generate_batches())
+        batch_generator = chain(prep_start.generate_batches(), batcher.generate_batches())
         high_resolution_eval_steps = list(range(0, prep_start.num_mbs, prep_start.num_mbs // 10))
-        num_train_mbs = prep_start.num_mbs + prep.num_mbs
+        num_train_mbs = prep_start.num_mbs + batcher.num_mbs
+        num_start_mbs = prep_start.num_mbs
     else:
-        batch_generator = prep.generate_batches()
+        batch_generator = batcher.generate_batches()
         high_resolution_eval_steps = [0]
-        num_train_mbs = prep.num_mbs
+        num_train_mbs = batcher.num_mbs
+        num_start_mbs = 0
+
+    # steps at which hidden state is reset - start windows are independent, and each is a sequence of its own
+    if params.truncated_bptt:
+        reset_steps = set(range(num_start_mbs)) | {num_start_mbs + step for step in batcher.reset_steps}
+    else:
+        reset_steps = set()
 
     # load all structures, for evaluation, each consisting of a dict mapping probe -> category,
     # make sure each probe is actually in the training data (may not be if isolated in test data)
     structure2probe2cat = defaultdict(dict)
+    token2f_train = Counter(prep.tokens_train)
+    token2f_valid = Counter(prep.tokens_valid)
     for structure in configs.Eval.structures:
         probe2cat = load_probe2cat(project_path, structure, params.corpus)
         for probe, cat in probe2cat.items():
             if probe not in probes_in_data:
                 continue
 
-            num_in_train = prep.tokens_train.count(probe)
-            num_in_valid = prep.tokens_valid.count(probe)
+            num_in_train = token2f_train[probe]
+            num_in_valid = token2f_valid[probe]
             if num_in_train == 0:
                 if num_in_valid == 0:
                     raise RuntimeError(f'"{probe:<24}" not in train or test data after tokenization.')
@@ -155,49 +273,102 @@ def main(param2val):
             else:
                 structure2probe2cat[structure][probe] = cat
 
-    # model
-    model = RNN(
-        params.flavor,
-        prep.num_types,
-        params.hidden_size,
-        params.num_layers,
-    )
+    # models - replicas are independently initialized, and trained in lockstep on the same batches
+    device = get_device()
+    is_batched = configs.Replicas.batched and params.num_replicas > 1 \
+        and params.flavor == 'srn' and params.num_layers == 1 and params.softmax == 'full' \
+        and (device.type == 'cuda' or configs.Replicas.batched_on_cpu)
+    replicas = []
+    for replica_id in range(params.num_replicas):
+        model = RNN(
+            params.flavor,
+            prep.num_types,
+            params.hidden_size,
+            params.num_layers,
+            device,
+        )
+        optimizer = None if is_batched else make_optimizer(model.parameters(), params)
+        # compiled module shares parameters with model, and is used for all forward passes, except in snapshots
+        forward_model = compile_model(model) if configs.Device.compile else model
+        # performance is streamed to file during training, in the same directory as the series saved at the end
+        replica_path = save_path if replica_id == 0 else save_path / f'replica_{replica_id}'
+        metrics_writer = MetricsWriter(replica_path / 'performance.jsonl')
+        replicas.append(Replica(model, forward_model, optimizer, metrics_writer))
 
-    # loss function
-    criterion = torch.nn.CrossEntropyLoss()
-    if params.optimizer == 'adagrad':
-        optimizer = torch.optim.Adagrad(model.parameters(), lr=params.lr)
-    elif params.optimizer == 'sgd':
-        optimizer = torch.optim.SGD(model.parameters(), lr=params.lr)
+    # batched replicas are trained with stacked weights, which are copied to each replica's model for evaluation
+    if is_batched:
+        stacked = StackedSRN([replica.model for replica in replicas])
+        stacked_optimizer = make_optimizer(stacked.parameters(), params)
+        forward_stacked = torch.compile(stacked) if configs.Device.compile and hasattr(torch, 'compile') else stacked
+        stacked_hidden = None
+        optimizers = [stacked_optimizer]
+        print(f'Training {params.num_replicas} replicas as one batched model')
     else:
-        raise AttributeError('Invalid arg to "optimizer"')
+        stacked = None
+        optimizers = [replica.optimizer for replica in replicas]
 
-    # initialize dictionary for collecting performance data
-    performance = {'train_pp': [], 'test_pp': []}
+    # loss function
+    if params.softmax == 'sampled':
+        # sample negative words from the smoothed unigram distribution of the training data
+        id2f_train = np.array([token2f_train[t] for t in prep.types], dtype=np.float64)
+        sampling_probs = torch.tensor(id2f_train ** 0.75 / np.sum(id2f_train ** 0.75),
+                                      dtype=torch.float, device=device)
+        sampling_probs.clamp_(min=1e-12)  # types not in training data must not have log_q=-inf
+    elif params.softmax == 'full':
+        sampling_probs = None
+    else:
+        raise AttributeError('Invalid arg to "softmax"')
 
-    # train and eval
     eval_steps = []  # to keep track when performance is evaluated
+
+    # resume from checkpoint if a previous run of this job was interrupted
+    checkpoint_path = save_path / 'checkpoint.pt'
+    if configs.Checkpoint.enabled:
+        checkpoint = load_checkpoint(checkpoint_path, [replica.model for replica in replicas], optimizers)
+    else:
+        checkpoint = None
+    if checkpoint is not None:
+        for replica, performance in zip(replicas, checkpoint['performances']):
+            replica.performance = performance
+        eval_steps = checkpoint['eval_steps']
+        start_step = checkpoint['step'] + 1
+        if stacked is not None:
+            stacked.copy_from([replica.model for replica in replicas])
+            stacked_hidden, = checkpoint['hiddens']
+        else:
+            for replica, hidden in zip(replicas, checkpoint['hiddens']):
+                replica.hidden = hidden
+    else:
+        start_step = 0
+
+    # optionally evaluate in a background thread, so that training is not blocked
+    if configs.Eval.asynchronous:
+        eval_pool = ThreadPoolExecutor(max_workers=1)
+    else:
+        eval_pool = None
+
+    # time spent in each phase of training and evaluation, including waiting for batches and copying them to the device
+    profiler = Profiler(configs.Profile.enabled, device)
+
+    # train and eval - batches consumed before the checkpoint are skipped
     start_train = time.time()
-    pbar = pyprind.ProgBar(num_train_mbs, stream=1)
-    for step, windows in enumerate(batch_generator):
-
-        if step != 0:
-            context_size = windows.shape[1] - 1  # different depending on whether input is from prep_start
-            x, y = np.split(windows, [context_size], axis=1)
-            inputs = torch.cuda.LongTensor(x)
-            targets = torch.cuda.LongTensor(np.squeeze(y))
-
-            # forward step
-            model.batch_size = len(windows)  # dynamic batch size
-            model.train()
-            logits = model(inputs)['logits']  # initial hidden state defaults to zero if not provided
-
-            # backward step
-            optimizer.zero_grad()  # sets all gradients to zero
-            loss = criterion(logits, targets)
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            optimizer.step()
+    pbar = pyprind.ProgBar(num_train_mbs - start_step, stream=1)
+    batches = BatchPrefetcher(islice(batch_generator, start_step, None), device, configs.Pipeline.prefetch_depth,
+                              all_time_steps=params.truncated_bptt, profiler=profiler)
+    for step, (inputs, targets) in enumerate(batches, start=start_step):
+
+        if step != 0 and stacked is not None:
+            if params.truncated_bptt and step in reset_steps:
+                stacked_hidden = None  # initial hidden state defaults to zero
+            stacked_hidden = train_stacked_step(stacked, forward_stacked, stacked_optimizer, inputs, targets,
+                                                params, profiler, stacked_hidden)
+
+        elif step != 0:
+            for replica in replicas:
+                if params.truncated_bptt and step in reset_steps:
+                    replica.hidden = None  # initial hidden state defaults to zero
+                replica.hidden = train_step(replica.model, replica.forward_model, replica.optimizer, inputs, targets,
+                                            params, profiler, replica.hidden, sampling_probs)
 
         pbar.update()
 
@@ -205,20 +376,24 @@ def main(param2val):
         if step % configs.Eval.num_steps_to_eval == 0 \
                 or step in high_resolution_eval_steps:  # eval with higher resolution at start
             eval_steps.append(step)
-            model.eval()
-            performance = update_pp_performance(performance, model, criterion, prep)
-
-            performance = update_ba_performance(performance, model, prep, structure2probe2cat)
-            # performance = update_cs_performance(performance, model, prep, structure2probe2cat)  # TODO slow
-            performance = update_dp_performance(performance, model, prep, structure2probe2cat)
-            performance = update_si_performance(performance, model, prep, structure2probe2cat)
-            performance = update_sd_performance(performance, model, prep, structure2probe2cat)
-
-            for k, v in performance.items():
-                if not v:
-                    continue
-                print(f'{k: <12}={v[-1]:.2f}')
-            print(flush=True)
+            if stacked is not None:
+                stacked.copy_to([replica.model for replica in replicas])
+            for replica in replicas:
+                if eval_pool is None:
+                    replica.model.eval()
+                    replica.performance = update_performance(replica.performance, replica.forward_model,
+                                                             prep, structure2probe2cat, step, replica.metrics_writer,
+                                                             profiler)
+                else:
+                    # evaluate a snapshot of the weights in the background, and merge results in order of steps
+                    with profiler.time('eval_snapshot'):
+                        snapshot = copy.deepcopy(replica.model).eval()
+                    replica.pending_evals.append(eval_pool.submit(update_performance, {'train_pp': [], 'test_pp': []},
+                                                                  snapshot, prep, structure2probe2cat, step,
+                                                                  replica.metrics_writer, profiler))
+                    with profiler.time('eval_wait'):
+                        while len(replica.pending_evals) > configs.Eval.max_num_pending_evals:
+                            merge_performance(replica.performance, replica.pending_evals.pop(0).result())
 
             # print progress to console
             minutes_elapsed = int(float(time.time() - start_train) / 60)
@@ -226,13 +401,43 @@ def main(param2val):
             print(f'minutes elapsed={minutes_elapsed}')
             print(flush=True)
 
-    # collect performance in list of pandas series
-    res = []
-    for k, v in performance.items():
-        if not v:
-            continue
-        transcript = pd.Series(v, index=eval_steps)
-        transcript.name = k
-        res.append(transcript)
+        # save checkpoint - background evaluation must be complete, to save all performance collected so far
+        if configs.Checkpoint.enabled and step != 0 and step % configs.Checkpoint.num_steps == 0:
+            with profiler.time('eval_wait'):
+                for replica in replicas:
+                    while replica.pending_evals:
+                        merge_performance(replica.performance, replica.pending_evals.pop(0).result())
+            with profiler.time('checkpoint'):
+                if stacked is not None:
+                    stacked.copy_to([replica.model for replica in replicas])
+                save_checkpoint(checkpoint_path,
+                                [replica.model for replica in replicas],
+                                optimizers,
+                                step,
+                                [replica.performance for replica in replicas],
+                                eval_steps,
+                                [stacked_hidden] if stacked is not None else [replica.hidden for replica in replicas])
 
-    return res
+    # wait for background evaluation to finish
+    if eval_pool is not None:
+        for replica in replicas:
+            for future in replica.pending_evals:
+                merge_performance(replica.performance, future.result())
+        eval_pool.shutdown()
+
+    if configs.Profile.enabled:
+        profiler.save_report(save_path / 'profile.json')
+
+    # training completed, so checkpoint is no longer needed
+    if checkpoint_path.exists():
+        checkpoint_path.unlink()
+
+    # save performance of additional replicas in sub-directories, where they are found like those of other jobs
+    for replica_id, replica in enumerate(replicas[1:], start=1):
+        replica_path = save_path / f'replica_{replica_id}'
+        replica_path.mkdir(parents=True, exist_ok=True)
+        for series in make_series(replica.performance, eval_steps):
+            series.to_csv(replica_path / f'{series.name}.csv')
+
+    # performance of first replica is returned to and saved by Ludwig
+    return make_series(replicas[0].performance, eval_steps)
@@ -0,0 +1,40 @@
+import json
+from pathlib import Path
+from typing import Dict
+
+import pandas as pd
+
+
+class MetricsWriter:
+    """
+    append performance at each eval step as one line of json to a file, which is flushed immediately,
+    so that learning curves can be inspected during training, and survive a crash.
+    """
+
+    def __init__(self,
+                 path: Path,
+                 ):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self,
+              step: int,
+              name2value: Dict[str, float],
+              ) -> None:
+        row = {'step': int(step)}
+        row.update({name: float(value) for name, value in name2value.items()})
+        with self.path.open('a') as f:
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+
+
+def read_metrics(path: Path,
+                 ) -> pd.DataFrame:
+    """
+    read file written by MetricsWriter into a data frame with one column per metric, indexed by step.
+    if a job was resumed from a checkpoint, steps evaluated twice keep only their most recent values.
+    """
+    df = pd.read_json(path, lines=True)
+    if df.empty:
+        return df
+    return df.drop_duplicates(subset='step', keep='last').set_index('step').sort_index()
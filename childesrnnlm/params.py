@@ -27,6 +27,9 @@ param2default = {
     'flavor': 'srn',  # simple-recurrent
     'hidden_size': 512,
     'num_layers': 1,
+    'softmax': 'full',  # or sampled, to reduce cost of training with large vocab, evaluation always uses full
+    'num_softmax_samples': 1024,  # number of negative samples per mini-batch, if softmax is sampled
+    'truncated_bptt': False,  # carry hidden state across consecutive chunks, and compute loss at every time step
 
     'sliding': False,
     'reverse': False,
@@ -34,6 +37,7 @@ param2default = {
     'batch_size': 64,
     'lr': 0.01,
     'optimizer': 'adagrad',
+    'num_replicas': 1,  # independently initialized models trained in lockstep on the same batches
 
 }
 
@@ -54,6 +58,9 @@ class Params:
     flavor: str
     hidden_size: int
     num_layers: int
+    softmax: str
+    num_softmax_samples: int
+    truncated_bptt: bool
 
     reverse: bool
     sliding: bool
@@ -61,6 +68,7 @@ class Params:
     batch_size: int
     lr: float
     optimizer: str
+    num_replicas: int
 
     @classmethod
     def from_param2val(cls, param2val):
@@ -68,7 +76,10 @@ class Params:
         instantiate class.
         exclude keys from param2val which are added by Ludwig.
         they are relevant to job submission only.
+        params which were added after a job was run are missing from its param2val, and take their default values.
         """
         kwargs = {k: v for k, v in param2val.items()
                   if k not in ['job_name', 'param_name', 'save_path', 'project_path']}
+        for k, v in param2default.items():
+            kwargs.setdefault(k, v)
         return cls(**kwargs)
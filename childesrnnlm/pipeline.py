@@ -0,0 +1,117 @@
+import queue
+import threading
+import numpy as np
+import torch
+from typing import Iterator, Iterable, Tuple, Set, Optional
+
+from childesrnnlm.profiling import Profiler
+
+
+class BatchPrefetcher:
+    """
+    split windows into inputs and targets, and convert them to tensors in a background thread,
+    so that the training loop only needs to copy ready-made tensors to the device.
+
+    windows may differ in context size (e.g. start windows followed by regular windows),
+    because each window batch is split independently.
+
+    if all_time_steps is True, targets are the next token at every position in the window, not only the last.
+
+    if a profiler is given, waiting for the next batch and copying it to the device are timed as separate phases.
+    """
+
+    def __init__(self,
+                 batch_generator: Iterable[np.ndarray],
+                 device: torch.device,
+                 prefetch_depth: int,
+                 all_time_steps: bool = False,
+                 profiler: Optional[Profiler] = None,
+                 ):
+        self.batch_generator = batch_generator
+        self.device = device
+        self.profiler = profiler or Profiler(enabled=False, device=device)
+        self.all_time_steps = all_time_steps
+        self.pin_memory = device.type == 'cuda'
+        self.queue = queue.Queue(maxsize=prefetch_depth)
+        self.thread = threading.Thread(target=self.fill_queue, daemon=True)
+        self.thread.start()
+
+    def fill_queue(self) -> None:
+        try:
+            for windows in self.batch_generator:
+                # windows may be a compact integer type, which is not supported by torch
+                inputs = torch.from_numpy(windows[:, :-1].astype(np.int64))
+                targets = torch.from_numpy((windows[:, 1:] if self.all_time_steps else windows[:, -1]).astype(np.int64))
+                if self.pin_memory:
+                    inputs = inputs.pin_memory()
+                    targets = targets.pin_memory()
+                self.queue.put((inputs, targets))
+        except Exception as e:  # re-raised in the training loop
+            self.queue.put(e)
+        else:
+            self.queue.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[torch.LongTensor, torch.LongTensor]]:
+        while True:
+            with self.profiler.time('batch'):
+                item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            inputs, targets = item
+            with self.profiler.time('h2d_copy'):
+                inputs = inputs.to(self.device, non_blocking=True)
+                targets = targets.to(self.device, non_blocking=True)
+            yield inputs, targets
+
+
+class StatefulBatcher:
+    """
+    generate windows for training with truncated backprop-through-time.
+
+    like Prep, the training tokens are split into parts, which are ordered by age (or reversed),
+    and each part is iterated over a number of times interpolated between num_iterations.
+    in each pass over a part, the part is split into batch_size contiguous streams of tokens,
+    and each mini-batch holds the next chunk of context_size tokens of every stream, plus one token for the targets,
+    so that the hidden state at the end of one chunk is the correct initial hidden state of the next.
+    """
+
+    def __init__(self,
+                 token_ids: np.ndarray,
+                 batch_size: int,
+                 context_size: int,
+                 num_parts: int,
+                 num_iterations: Tuple[int, int],
+                 reverse: bool,
+                 ):
+        self.batch_size = batch_size
+        self.context_size = context_size
+
+        parts = np.array_split(token_ids, num_parts)
+        if reverse:
+            parts = parts[::-1]
+        num_iterations_list = np.linspace(num_iterations[0], num_iterations[1], num_parts).round().astype(int)
+        self.passes = [part for part, n in zip(parts, num_iterations_list) for _ in range(n)]
+
+        # hidden state must be reset at the start of each pass, where streams are not continuous
+        self.reset_steps: Set[int] = set()
+        self.num_mbs = 0
+        for part in self.passes:
+            self.reset_steps.add(self.num_mbs)
+            self.num_mbs += self.calc_num_chunks(part)
+
+    def calc_num_chunks(self, part: np.ndarray) -> int:
+        stream_length = len(part) // self.batch_size
+        return max(0, (stream_length - 1) // self.context_size)
+
+    def generate_batches(self) -> Iterator[np.ndarray]:
+        """
+        yield windows with shape [batch_size, context_size + 1], where consecutive windows overlap by one token
+        """
+        for part in self.passes:
+            stream_length = len(part) // self.batch_size
+            streams = part[:stream_length * self.batch_size].reshape(self.batch_size, stream_length)
+            for n in range(self.calc_num_chunks(part)):
+                start = n * self.context_size
+                yield streams[:, start:start + self.context_size + 1]
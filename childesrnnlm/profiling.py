@@ -0,0 +1,89 @@
+import contextlib
+import json
+import resource
+import threading
+import time
+import torch
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Any
+
+NULL_CONTEXT = contextlib.nullcontext()
+TRAIN_PHASES = ('batch', 'h2d_copy', 'forward', 'backward', 'clip_grad_norm', 'optimizer_step')
+
+
+class Profiler:
+    """
+    accumulate wall time spent in named phases (e.g. forward, backward, each scorer) and named counters.
+
+    when not enabled, time() returns a shared no-op context, so that instrumentation can stay in the training loop.
+    when enabled, cuda is synchronized at phase boundaries, so that asynchronous kernels are attributed correctly.
+
+    phases whose names start with "eval" are counted as evaluation. if evaluation runs in a background thread,
+    its phases overlap with training, and eval_share may over-estimate how much training was slowed down.
+    """
+
+    def __init__(self,
+                 enabled: bool,
+                 device: torch.device,
+                 ):
+        self.enabled = enabled
+        self.sync = device.type == 'cuda'
+        self.device = device
+        self.phase2seconds: Dict[str, float] = defaultdict(float)
+        self.phase2calls: Dict[str, int] = defaultdict(int)
+        self.name2count: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()  # phases may also be timed in a background evaluation thread
+        self.start = time.perf_counter()
+
+    def time(self, phase: str):
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self.timer(phase)
+
+    @contextlib.contextmanager
+    def timer(self, phase: str):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            with self.lock:
+                self.phase2seconds[phase] += time.perf_counter() - start
+                self.phase2calls[phase] += 1
+
+    def count(self, name: str, value: int) -> None:
+        if self.enabled:
+            self.name2count[name] += value
+
+    def make_report(self) -> Dict[str, Any]:
+        wall_seconds = time.perf_counter() - self.start
+        eval_seconds = sum(s for p, s in self.phase2seconds.items() if p.startswith('eval'))
+        train_seconds = sum(self.phase2seconds[p] for p in TRAIN_PHASES if p in self.phase2seconds)
+        if self.device.type == 'cuda':
+            peak_memory_mb = torch.cuda.max_memory_allocated(self.device) / 1024 ** 2
+        else:
+            peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on linux
+        return {
+            'wall_seconds': wall_seconds,
+            'phase2seconds': dict(self.phase2seconds),
+            'phase2calls': dict(self.phase2calls),
+            'phase2share': {p: s / wall_seconds for p, s in self.phase2seconds.items()},
+            'eval_share': eval_seconds / wall_seconds,
+            'counts': dict(self.name2count),
+            'tokens_per_second': self.name2count['tokens'] / train_seconds if train_seconds else None,
+            'peak_memory_mb': peak_memory_mb,
+        }
+
+    def save_report(self, path: Path) -> None:
+        report = self.make_report()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as f:
+            json.dump(report, f, indent=4)
+        for phase, seconds in sorted(report['phase2seconds'].items(), key=lambda i: -i[1]):
+            print(f'{phase:<24} {seconds:>10.1f}s {report["phase2share"][phase]:>6.1%}')
+        print(f'tokens per second={report["tokens_per_second"]}')
+        print(f'Saved profile to {path}', flush=True)
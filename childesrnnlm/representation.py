@@ -1,70 +1,212 @@
+import weakref
 import numpy as np
 import torch
-from typing import Union
+from typing import Union, Tuple, List, Dict
 
 from preppy import Prep
 
 from childesrnnlm import configs
+from childesrnnlm.device import autocast
 from childesrnnlm.rnn import RNN
+from childesrnnlm.windows import get_window_store
+
+# inverted index over windows, made once per Prep instance
+prep2window_index = weakref.WeakKeyDictionary()
+
+
+def gather_embeddings(model: RNN,
+                      word_ids,
+                      ) -> torch.Tensor:
+    """
+    gather embeddings of word_ids on device, without copying the embeddings of the full vocab
+    """
+    ids = torch.tensor(word_ids, dtype=torch.long, device=model.device)
+    return model.embed.weight.detach()[ids]
 
 
 def make_representations_without_context(model, word_ids):
     """
-    make word representations without context by retrieving embeddings
+    make word representations without context by retrieving embeddings.
+    only embeddings of word_ids are copied to host.
     """
-    vocab_reps = model.embed.weight.detach().cpu().numpy()
-    probe_reps_n = vocab_reps[word_ids]
+    probe_reps_n = gather_embeddings(model, word_ids).cpu().numpy()
     return probe_reps_n
 
 
+def calc_cosine_similarities(reps: torch.Tensor,
+                             ) -> torch.Tensor:
+    """
+    compute cosine similarities between all rows of reps on the device of reps, like sklearn's cosine_similarity.
+    rows are normalized once, so that all similarities are computed in one matrix multiplication.
+    """
+    normalized = torch.nn.functional.normalize(reps, dim=1)
+    return normalized @ normalized.t()
+
+
+def make_window_index(windows: np.ndarray,
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    make an inverted index from token id to the ids of all windows whose last input token is that token id.
+    the windows of token id i are window_ids[offsets[i]:offsets[i + 1]].
+
+    ids and offsets are int32, rather than the int64 of argsort, because the index is kept in memory for the whole job.
+    """
+    assert len(windows) < np.iinfo(np.int32).max, len(windows)
+    last_input_ids = windows[:, -2]
+    window_ids = np.argsort(last_input_ids, kind='stable').astype(np.int32)
+    offsets = np.zeros(last_input_ids.max() + 2, dtype=np.int32)
+    np.cumsum(np.bincount(last_input_ids), out=offsets[1:])
+    return window_ids, offsets
+
+
+def get_window_index(prep: Prep,
+                     ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    return the inverted index over the windows in prep, which is made only once per job
+    """
+    if prep not in prep2window_index:
+        prep2window_index[prep] = make_window_index(get_window_store(prep).windows)
+    return prep2window_index[prep]
+
+
 def make_representations_with_context(model: RNN,
                                       token_ids,
                                       prep: Prep,
                                       verbose=False,
                                       ) -> np.array:
     """
-    make word representations by averaging over all contextualized representations
+    make word representations by averaging over all contextualized representations.
+
+    windows of all probes are streamed through the model in large batches,
+    and last encodings are summed per probe, rather than running a forward pass for each probe.
     """
-    all_windows = prep.reordered_windows
+    all_windows = get_window_store(prep).windows
+    window_ids, offsets = get_window_index(prep)
 
-    num_words = len(token_ids)
-    probe_reps_o = np.zeros((num_words, model.hidden_size))
+    # collect windows for all probes
+    selected_window_ids = []
+    owner_ids = []
     for n, token_id in enumerate(token_ids):
-        bool_idx = np.isin(all_windows[:, -2], token_id)
-        x = all_windows[bool_idx][:, :-1]
+        if token_id + 1 < len(offsets):
+            x_ids = window_ids[offsets[token_id]:offsets[token_id + 1]]
+        else:
+            x_ids = window_ids[:0]
 
         # TODO does this matter?
-        if len(x) > configs.Eval.max_num_exemplars:
-            x = x[np.random.choice(len(x), size=configs.Eval.max_num_exemplars)]
+        if len(x_ids) > configs.Eval.max_num_exemplars:
+            x_ids = x_ids[np.random.choice(len(x_ids), size=configs.Eval.max_num_exemplars)]
 
-        inputs = torch.cuda.LongTensor(x)
-        num_exemplars, dim1 = inputs.shape
-        assert dim1 == prep.context_size, (inputs.shape, x.shape, prep.context_size)
         if verbose:
-            print(f'Made {num_exemplars:>6} representations for {prep.types[token_id]:<12}')
-        probe_exemplar_reps = model(inputs)['last_encodings'].detach().cpu().numpy()  # [num exemplars, hidden_size]
-        probe_reps_o[n] = probe_exemplar_reps.mean(axis=0)
+            print(f'Made {len(x_ids):>6} representations for {prep.types[token_id]:<12}')
+        selected_window_ids.append(x_ids)
+        owner_ids.append(np.full(len(x_ids), n))
+    selected_window_ids = np.concatenate(selected_window_ids)
+    owner_ids = np.concatenate(owner_ids)
+
+    # sum contextualized representations per probe
+    num_words = len(token_ids)
+    rep_sums = torch.zeros((num_words, model.hidden_size), device=model.device)
+    batch_size = configs.Eval.representation_batch_size
+    with torch.no_grad():
+        for start in range(0, len(selected_window_ids), batch_size):
+            x = all_windows[selected_window_ids[start:start + batch_size]][:, :-1].astype(np.int64)
+            inputs = torch.tensor(x, device=model.device)
+            assert inputs.shape[1] == prep.context_size, (inputs.shape, x.shape, prep.context_size)
+            with autocast(model.device):
+                last_encodings = model(inputs)['last_encodings'].view(-1, model.hidden_size)
+            owners = torch.tensor(owner_ids[start:start + batch_size], dtype=torch.long, device=model.device)
+            rep_sums.index_add_(0, owners, last_encodings.float())
+
+    # average - probes without any windows have nan representations
+    num_exemplars = np.bincount(owner_ids, minlength=num_words)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        probe_reps_o = rep_sums.cpu().numpy().astype(np.float64) / num_exemplars[:, np.newaxis]
     return probe_reps_o
 
 
+class RepresentationCache:
+    """
+    holds probe representations made at a single eval step,
+    so that the scorers in evaluation.py compute each kind of representation only once.
+
+    representations are made for the union of probes across all structures,
+    and each scorer receives only the rows for the probes of its structure.
+    likewise, similarities between representations are computed once for all probes, and sliced per structure.
+    """
+
+    def __init__(self,
+                 model: RNN,
+                 prep: Prep,
+                 step: int,
+                 token_ids: List[int],
+                 ):
+        self.model = model
+        self.prep = prep
+        self.step = step
+        self.token_ids = sorted(set(token_ids))
+        self.token_id2row = {token_id: n for n, token_id in enumerate(self.token_ids)}
+        self.key2reps: Dict[Tuple[str, int], np.ndarray] = {}
+
+    def get(self,
+            kind: str,
+            token_ids: List[int],
+            ) -> np.ndarray:
+        """
+        return representations for token_ids, where kind is "o" (with context), "n" (without context),
+        or "output" (log-probabilities of next words without context)
+        """
+        key = (kind, self.step)
+        if key not in self.key2reps:
+            if kind == 'o':
+                reps = make_representations_with_context(self.model, self.token_ids, self.prep)
+            elif kind == 'n':
+                reps = make_representations_without_context(self.model, self.token_ids)
+            elif kind == 'output':
+                reps = make_output_representations(self.model, [self.prep.types[i] for i in self.token_ids], self.prep)
+            else:
+                raise AttributeError('Invalid arg to "kind".')
+            self.key2reps[key] = reps
+
+        return self.key2reps[key][[self.token_id2row[token_id] for token_id in token_ids]]
+
+    def get_sims(self,
+                 kind: str,
+                 token_ids: List[int],
+                 ) -> np.ndarray:
+        """
+        return cosine similarities between representations of token_ids, where kind is "o" or "n".
+        similarities are computed on device, and for "n", embeddings of probes are gathered on device.
+        """
+        key = (f'{kind}_sims', self.step)
+        if key not in self.key2reps:
+            if kind == 'o':
+                reps = torch.tensor(self.get('o', self.token_ids), device=self.model.device)
+            elif kind == 'n':
+                reps = gather_embeddings(self.model, self.token_ids)
+            else:
+                raise AttributeError('Invalid arg to "kind".')
+            self.key2reps[key] = calc_cosine_similarities(reps).cpu().numpy()
+
+        rows = [self.token_id2row[token_id] for token_id in token_ids]
+        return self.key2reps[key][np.ix_(rows, rows)]
+
+
 def make_output_representations(model: RNN,
                                 probes,
                                 prep: Prep,
                                 ) -> np.array:
+    """
+    make log-probabilities of next words given each probe without context.
+    log-softmax is computed on device, in chunks of probes to bound memory,
+    and only float32 log-probabilities are copied to host.
+    """
     w_ids = [prep.token2id[w] for w in probes]
-    x = np.expand_dims(np.array(w_ids), axis=1)
-    inputs = torch.cuda.LongTensor(x)
-    logits = model(inputs)['logits'].detach().cpu().numpy()
-    res = softmax(logits)
+    batch_size = configs.Eval.representation_batch_size
+    res = np.zeros((len(w_ids), prep.num_types), dtype=np.float32)
+    with torch.no_grad():
+        for start in range(0, len(w_ids), batch_size):
+            inputs = torch.tensor(w_ids[start:start + batch_size], dtype=torch.long, device=model.device)
+            with autocast(model.device):
+                logits = model(inputs.unsqueeze(1))['logits'].view(len(inputs), -1)
+            res[start:start + batch_size] = torch.log_softmax(logits.float(), dim=1).cpu().numpy()
     return res
-
-
-def softmax(z) -> np.array:
-    a = 1  # should be 1 if rows should sum to 1
-    z_norm = np.exp(z - np.max(z, axis=a, keepdims=True))
-    res = np.divide(z_norm, np.sum(z_norm, axis=a, keepdims=True))
-
-    # check that softmax works correctly - row sum must be close to 1
-    assert round(res[0, :].sum().item(), 2) == 1
-
-    return res
\ No newline at end of file
@@ -1,5 +1,9 @@
 import torch
 import numpy as np
+from typing import Dict, Any, Optional, Tuple, Union, List
+
+# hidden state of srn, or hidden and cell state of lstm
+Hidden = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]
 
 
 class RNN(torch.nn.Module):
@@ -8,10 +12,12 @@ class RNN(torch.nn.Module):
                  input_size: int,
                  hidden_size: int,
                  num_layers: int,
+                 device: torch.device,
                  ):
 
         super().__init__()
         self.hidden_size = hidden_size
+        self.device = device
 
         # define operations
         self.embed = torch.nn.Embedding(input_size, hidden_size)  # embed_size does not have to be hidden_size
@@ -36,17 +42,277 @@ class RNN(torch.nn.Module):
         self.project.weight.data.uniform_(-max_w, max_w)
         self.project.bias.data.fill_(0.0)
 
-        self.cuda()
+        self.to(device)
 
-        print(f'Initialized {flavor} with input_size={input_size}')
+        print(f'Initialized {flavor} with input_size={input_size} on device={device}')
 
     def forward(self,
-                inputs: torch.cuda.LongTensor
-                ) -> torch.cuda.LongTensor:
+                inputs: torch.LongTensor,
+                project: bool = True,
+                hidden: Optional[Hidden] = None,
+                all_time_steps: bool = False,
+                ) -> Dict[str, Any]:
+        """
+        if project is False, logits are not computed, e.g. when training with sampled softmax.
+
+        if all_time_steps is True, encodings and logits are returned for every time step, not only the last,
+        e.g. when training with truncated backprop-through-time.
+        hidden is the initial hidden state, which defaults to zero if None,
+        and the final hidden state is returned, so that it can be carried over to the next chunk of a sequence.
+        """
 
         embedded = self.embed(inputs)
-        encoded, _ = self.encode(embedded)  # returns all time steps [batch_size, context_size, hidden_size]
+        encoded, hidden = self.encode(embedded, hidden)  # all time steps [batch_size, context_size, hidden_size]
+        if all_time_steps:
+            res = {'encodings': encoded, 'hidden': hidden}
+            if project:
+                res['logits'] = self.project(encoded)  # [batch_size, context_size, input_size]
+            return res
+
         last_encodings = torch.squeeze(encoded[:, -1])  # [batch_size, hidden_size]
+        if not project:
+            return {'last_encodings': last_encodings, 'hidden': hidden}
         logits = self.project(last_encodings)  # [batch_size, input_size]
 
-        return {'last_encodings': last_encodings, 'logits': logits}
\ No newline at end of file
+        return {'last_encodings': last_encodings, 'logits': logits, 'hidden': hidden}
+
+    def calc_sampled_softmax_loss(self,
+                                  last_encodings: torch.Tensor,
+                                  targets: torch.LongTensor,
+                                  sampling_probs: torch.Tensor,
+                                  num_samples: int,
+                                  ) -> torch.Tensor:
+        """
+        approximate cross-entropy loss over the full vocab by computing logits only for targets,
+        and for negative samples drawn from sampling_probs, which are shared across the mini-batch.
+        logits of negative samples are corrected by the log of the expected number of times each word is sampled,
+        so that together with the target they estimate the full partition function,
+        and negative samples which are identical to the target are excluded.
+        """
+        sample_ids = torch.multinomial(sampling_probs, num_samples, replacement=True)  # [num_samples]
+        log_q = torch.log(sampling_probs * num_samples)
+
+        w = self.project.weight
+        b = self.project.bias
+        target_logits = (last_encodings * w[targets]).sum(dim=1) + b[targets]
+        sample_logits = last_encodings @ w[sample_ids].t() + b[sample_ids] - log_q[sample_ids]
+        is_hit = sample_ids.unsqueeze(0) == targets.unsqueeze(1)
+        sample_logits = sample_logits.masked_fill(is_hit, float('-inf'))
+
+        logits = torch.cat([target_logits.unsqueeze(1), sample_logits], dim=1)  # target is always at index 0
+        labels = torch.zeros(len(targets), dtype=torch.long, device=targets.device)
+        return torch.nn.functional.cross_entropy(logits.float(), labels)
+
+
+def detach_hidden(hidden: Hidden,
+                  ) -> Hidden:
+    """
+    cut the graph at the hidden state, so that gradients are not propagated into previous chunks of a sequence
+    """
+    if isinstance(hidden, tuple):
+        return tuple(h.detach() for h in hidden)
+    return hidden.detach()
+
+
+class LastStep(torch.nn.Module):
+    """
+    the default forward pass of RNN, which returns last encodings and logits at the last time step only,
+    in a form that can be compiled with TorchScript, which does not support the optional arguments of RNN.forward
+    """
+
+    def __init__(self,
+                 model: RNN,
+                 ):
+        super().__init__()
+        self.embed = model.embed
+        self.encode = model.encode
+        self.project = model.project
+
+    def forward(self,
+                inputs: torch.Tensor,
+                ) -> Tuple[torch.Tensor, torch.Tensor]:
+        embedded = self.embed(inputs)
+        encoded, _ = self.encode(embedded)
+        last_encodings = torch.squeeze(encoded[:, -1])
+        logits = self.project(last_encodings)
+        return last_encodings, logits
+
+
+class ScriptedRNN(torch.nn.Module):
+    """
+    use a TorchScript-compiled forward pass for the default forward pass of model (e.g. training with full softmax,
+    perplexity, and contextualized representations), and the eager model for all other forward passes.
+    parameters are shared with model, and attributes of model remain accessible.
+    """
+
+    def __init__(self,
+                 model: RNN,
+                 ):
+        super().__init__()
+        self.model = model
+        self.scripted = torch.jit.script(LastStep(model))
+
+    def forward(self,
+                inputs: torch.LongTensor,
+                project: bool = True,
+                hidden: Optional[Hidden] = None,
+                all_time_steps: bool = False,
+                ) -> Dict[str, Any]:
+        if not project or hidden is not None or all_time_steps:
+            return self.model(inputs, project=project, hidden=hidden, all_time_steps=all_time_steps)
+
+        last_encodings, logits = self.scripted(inputs)
+        return {'last_encodings': last_encodings, 'logits': logits}
+
+    def __getattr__(self, name: str):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.model, name)
+
+
+def compile_model(model: RNN,
+                  ) -> torch.nn.Module:
+    """
+    return a compiled module that shares parameters with model.
+    attributes of model (e.g. hidden_size, device, embed) remain accessible on the compiled module.
+    if torch.compile is not available (torch < 2.0), the default forward pass is compiled with TorchScript instead.
+    """
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available. Compiling default forward pass with TorchScript.', flush=True)
+        return ScriptedRNN(model)
+
+    return torch.compile(model)
+
+
+class StackedSRN(torch.nn.Module):
+    """
+    single-layer srn replicas with stacked weights, so that all replicas are trained in one forward and backward pass,
+    using batched matrix multiplications, rather than one replica at a time.
+
+    the recurrence is the same as that of torch.nn.RNN with tanh nonlinearity,
+    so that weights can be copied to and from the RNN instance of each replica, which is used for evaluation.
+    weight matrices are stored transposed relative to torch.nn.Linear, so that no copies are made in matrix products.
+    """
+
+    def __init__(self,
+                 models: List[RNN],
+                 ):
+        super().__init__()
+        self.num_replicas = len(models)
+        self.input_size = models[0].embed.num_embeddings
+        self.hidden_size = models[0].hidden_size
+        self.device = models[0].device
+
+        def stack(get_weight) -> torch.nn.Parameter:
+            return torch.nn.Parameter(torch.stack([get_weight(model).detach().clone() for model in models]))
+
+        # first dimension is replica
+        self.embed_weight = stack(lambda m: m.embed.weight)  # [num_replicas, input_size, hidden_size]
+        self.weight_ih = stack(lambda m: m.encode.weight_ih_l0.t())  # [num_replicas, hidden_size, hidden_size]
+        self.weight_hh = stack(lambda m: m.encode.weight_hh_l0.t())
+        self.bias_ih = stack(lambda m: m.encode.bias_ih_l0)  # [num_replicas, hidden_size]
+        self.bias_hh = stack(lambda m: m.encode.bias_hh_l0)
+        self.project_weight = stack(lambda m: m.project.weight.t())  # [num_replicas, hidden_size, input_size]
+        self.project_bias = stack(lambda m: m.project.bias)  # [num_replicas, input_size]
+
+    def get_weights(self,
+                    model: RNN,
+                    ) -> List[Tuple[torch.Tensor, torch.nn.Parameter]]:
+        """
+        return pairs of parameters of model (as views in the layout of the stacked parameters),
+        and the corresponding stacked parameters
+        """
+        return [(model.embed.weight, self.embed_weight),
+                (model.encode.weight_ih_l0.t(), self.weight_ih),
+                (model.encode.weight_hh_l0.t(), self.weight_hh),
+                (model.encode.bias_ih_l0, self.bias_ih),
+                (model.encode.bias_hh_l0, self.bias_hh),
+                (model.project.weight.t(), self.project_weight),
+                (model.project.bias, self.project_bias)]
+
+    def copy_to(self,
+                models: List[RNN],
+                ) -> None:
+        """
+        copy weights of each replica to its RNN instance, e.g. before evaluation and checkpointing
+        """
+        with torch.no_grad():
+            for n, model in enumerate(models):
+                for weight, weight_stacked in self.get_weights(model):
+                    weight.copy_(weight_stacked[n])
+
+    def copy_from(self,
+                  models: List[RNN],
+                  ) -> None:
+        """
+        copy weights of the RNN instance of each replica, e.g. after resuming from a checkpoint
+        """
+        with torch.no_grad():
+            for n, model in enumerate(models):
+                for weight, weight_stacked in self.get_weights(model):
+                    weight_stacked[n].copy_(weight)
+
+    def forward(self,
+                inputs: torch.LongTensor,
+                hidden: Optional[torch.Tensor] = None,
+                all_time_steps: bool = False,
+                ) -> Dict[str, torch.Tensor]:
+        """
+        all replicas receive the same inputs.
+        logits have shape [num_replicas, batch_size, input_size],
+        or [num_replicas, batch_size, context_size, input_size] if all_time_steps is True.
+        hidden has shape [num_replicas, batch_size, hidden_size], and defaults to zero.
+        """
+        batch_size, context_size = inputs.shape
+        num_replicas, hidden_size = self.num_replicas, self.hidden_size
+
+        # look up embeddings of all replicas at once, by offsetting ids into the embeddings of each replica
+        offsets = torch.arange(num_replicas, device=inputs.device).view(-1, 1, 1) * self.input_size
+        embedded = torch.nn.functional.embedding(inputs.unsqueeze(0) + offsets,
+                                                 self.embed_weight.view(-1, hidden_size))
+
+        # input transformation of all time steps at once
+        x = torch.baddbmm(self.bias_ih.unsqueeze(1),
+                          embedded.view(num_replicas, batch_size * context_size, hidden_size),
+                          self.weight_ih).view(num_replicas, batch_size, context_size, hidden_size)
+
+        if hidden is None:
+            hidden = torch.zeros(num_replicas, batch_size, hidden_size, dtype=x.dtype, device=x.device)
+        encodings = []
+        for t in range(context_size):
+            hidden = torch.tanh(x[:, :, t] + torch.baddbmm(self.bias_hh.unsqueeze(1), hidden, self.weight_hh))
+            encodings.append(hidden)
+
+        if all_time_steps:
+            encoded = torch.stack(encodings, dim=2).view(num_replicas, batch_size * context_size, hidden_size)
+            logits = torch.baddbmm(self.project_bias.unsqueeze(1), encoded, self.project_weight)
+            logits = logits.view(num_replicas, batch_size, context_size, -1)
+        else:
+            logits = torch.baddbmm(self.project_bias.unsqueeze(1), hidden, self.project_weight)
+
+        return {'logits': logits, 'hidden': hidden}
+
+    def calc_loss(self,
+                  logits: torch.Tensor,
+                  targets: torch.LongTensor,
+                  ) -> torch.Tensor:
+        """
+        sum over replicas of the mean cross-entropy of each replica,
+        so that each replica receives the same gradients as if it was trained alone
+        """
+        targets = targets.expand(self.num_replicas, *targets.shape)
+        loss = torch.nn.functional.cross_entropy(logits.reshape(-1, logits.shape[-1]).float(), targets.reshape(-1))
+        return loss * self.num_replicas
+
+    def clip_grad_norm_(self,
+                        max_norm: float,
+                        ) -> None:
+        """
+        clip gradients of each replica separately, like torch.nn.utils.clip_grad_norm_ applied to each replica
+        """
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        norms = torch.stack([grad.flatten(1).norm(dim=1) for grad in grads]).norm(dim=0)  # [num_replicas]
+        clip_coefficients = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coefficients.view(-1, *[1] * (grad.dim() - 1)))
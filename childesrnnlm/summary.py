@@ -1,10 +1,14 @@
 from pathlib import Path
 import numpy as np
-from typing import Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, List
 
 import pandas as pd
 from scipy.stats import sem, t
 
+from childesrnnlm.aggregation import load_series_from_index
+from childesrnnlm.metrics import read_metrics
+
 
 def make_summary(pattern: str,
                  path_to_search: Path,
@@ -13,14 +17,23 @@ def make_summary(pattern: str,
                  shift_x: Optional[int] = None,
                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, str, int]:
     """
-    load all csv files matching pattern and return mean and std across their contents
+    load all csv files matching pattern and return mean and std across their contents.
+    if path_to_search has an index made by aggregation.update_index(), read the series from the index instead,
+    which avoids reading many small files. a stale index (e.g. more jobs completed since it was made) is updated first.
+    if there are no csv files (e.g. jobs are still running), read the metric from streamed performance files instead.
     """
-    pattern = f'{pattern}.csv'
-    series_list = [pd.read_csv(p, index_col=0, squeeze=True)
-                   for p in path_to_search.rglob(pattern)]
+    series_list = load_series_from_index(path_to_search, pattern)
+    if not series_list:
+        series_list = [pd.read_csv(p, index_col=0, squeeze=True)
+                       for p in path_to_search.rglob(f'{pattern}.csv')]
+    if not series_list:
+        for p in path_to_search.rglob('performance.jsonl'):
+            df = read_metrics(p)
+            if pattern in df.columns:
+                series_list.append(df[pattern].dropna())
     n = len(series_list)
     if not series_list:
-        raise RuntimeError(f'Did not find any csv files matching pattern="{pattern}"')
+        raise RuntimeError(f'Did not find any csv or performance files with metric="{pattern}"')
     concatenated_df = pd.concat(series_list, axis=1)
     x = concatenated_df.index.values
     y_mean = concatenated_df.mean(axis=1).values.flatten()
@@ -31,4 +44,28 @@ def make_summary(pattern: str,
         print(f'Shifting x axis by {shift_x}')
         x -= shift_x
 
-    return x, y_mean, h, label, n
\ No newline at end of file
+    return x, y_mean, h, label, n
+
+
+def make_summaries(pattern: str,
+                   param_paths: List[Path],
+                   labels: List[str],
+                   confidence: float,
+                   shift_xs: Optional[List[Optional[int]]] = None,
+                   max_workers: int = 16,
+                   ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray, str, int]]:
+    """
+    make summaries for many param settings concurrently, and return them in the same order as param_paths.
+    threads are used because the time to make a summary is dominated by reading files from the file server.
+    """
+    if shift_xs is None:
+        shift_xs = [None] * len(param_paths)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        res = list(pool.map(make_summary,
+                            [pattern] * len(param_paths),
+                            param_paths,
+                            labels,
+                            [confidence] * len(param_paths),
+                            shift_xs))
+    return res
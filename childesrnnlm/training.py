@@ -0,0 +1,102 @@
+import torch
+from typing import Callable, Iterable, Optional
+
+from childesrnnlm.device import autocast
+from childesrnnlm.params import Params
+from childesrnnlm.profiling import Profiler
+from childesrnnlm.rnn import RNN, Hidden, StackedSRN, detach_hidden
+
+
+def make_optimizer(parameters: Iterable[torch.nn.Parameter],
+                   params: Params,
+                   ) -> torch.optim.Optimizer:
+    if params.optimizer == 'adagrad':
+        return torch.optim.Adagrad(parameters, lr=params.lr)
+    elif params.optimizer == 'sgd':
+        return torch.optim.SGD(parameters, lr=params.lr)
+    else:
+        raise AttributeError('Invalid arg to "optimizer"')
+
+
+def train_step(model: RNN,
+               forward_model: Callable,
+               optimizer: torch.optim.Optimizer,
+               inputs: torch.LongTensor,
+               targets: torch.LongTensor,
+               params: Params,
+               profiler: Profiler,
+               hidden: Optional[Hidden] = None,
+               sampling_probs: Optional[torch.Tensor] = None,
+               ) -> Optional[Hidden]:
+    """
+    train a single model on one mini-batch, using forward_model (e.g. a compiled version of model) for the forward pass.
+
+    with truncated backprop-through-time, the loss is computed at every time step,
+    and the hidden state to carry into the next mini-batch is returned (pass hidden=None to reset it to zero).
+    sampling_probs are required if params.softmax is sampled.
+    """
+    profiler.count('tokens', targets.numel())
+
+    # forward step
+    model.train()
+    with profiler.time('forward'), autocast(inputs.device):
+        if params.truncated_bptt:
+            output = forward_model(inputs, project=params.softmax == 'full', hidden=hidden, all_time_steps=True)
+            hidden = detach_hidden(output['hidden'])
+            targets_flat = targets.flatten()  # loss is computed at every time step
+            if params.softmax == 'full':
+                loss = torch.nn.functional.cross_entropy(output['logits'].flatten(0, 1), targets_flat)
+            else:
+                loss = model.calc_sampled_softmax_loss(output['encodings'].flatten(0, 1), targets_flat,
+                                                       sampling_probs, params.num_softmax_samples)
+        elif params.softmax == 'full':
+            logits = forward_model(inputs)['logits']  # initial hidden state defaults to zero
+            loss = torch.nn.functional.cross_entropy(logits, targets)
+        else:
+            last_encodings = forward_model(inputs, project=False)['last_encodings']
+            loss = model.calc_sampled_softmax_loss(last_encodings, targets,
+                                                   sampling_probs, params.num_softmax_samples)
+
+    # backward step
+    with profiler.time('backward'):
+        optimizer.zero_grad()  # sets all gradients to zero
+        loss.backward()
+    with profiler.time('clip_grad_norm'):
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+    with profiler.time('optimizer_step'):
+        optimizer.step()
+
+    return hidden if params.truncated_bptt else None
+
+
+def train_stacked_step(stacked: StackedSRN,
+                       forward_stacked: Callable,
+                       optimizer: torch.optim.Optimizer,
+                       inputs: torch.LongTensor,
+                       targets: torch.LongTensor,
+                       params: Params,
+                       profiler: Profiler,
+                       hidden: Optional[torch.Tensor] = None,
+                       ) -> Optional[torch.Tensor]:
+    """
+    train all replicas of stacked on one mini-batch, in one forward and backward pass.
+    like train_step(), the hidden state to carry into the next mini-batch is returned, if training with truncated bptt.
+    """
+    profiler.count('tokens', targets.numel() * stacked.num_replicas)
+
+    # forward step of all replicas at once
+    stacked.train()
+    with profiler.time('forward'), autocast(inputs.device):
+        output = forward_stacked(inputs, hidden=hidden, all_time_steps=params.truncated_bptt)
+        loss = stacked.calc_loss(output['logits'], targets)
+
+    # backward step
+    with profiler.time('backward'):
+        optimizer.zero_grad()
+        loss.backward()
+    with profiler.time('clip_grad_norm'):
+        stacked.clip_grad_norm_(1.0)
+    with profiler.time('optimizer_step'):
+        optimizer.step()
+
+    return output['hidden'].detach() if params.truncated_bptt else None
@@ -0,0 +1,66 @@
+import weakref
+import numpy as np
+from typing import Iterator, Iterable, Optional
+
+from preppy import Prep
+
+from childesrnnlm.cache import load_windows, save_windows
+
+# window store of each Prep instance, used in place of the in-memory windows of Prep
+prep2window_store = weakref.WeakKeyDictionary()
+
+
+class WindowStore:
+    """
+    the training windows of a Prep instance, in the same order, usually memory-mapped from a compact file in cache.
+
+    batches are views into the windows, so that no copy is made until a batch is converted to a tensor.
+    """
+
+    def __init__(self,
+                 windows: np.ndarray,
+                 batch_size: int,
+                 ):
+        self.windows = windows
+        self.batch_size = batch_size
+        self.num_mbs = len(windows) // batch_size
+
+    def generate_batches(self,
+                         mb_ids: Optional[Iterable[int]] = None,
+                         ) -> Iterator[np.ndarray]:
+        """
+        yield all mini-batches in order, or only those in mb_ids
+        """
+        if mb_ids is None:
+            mb_ids = range(self.num_mbs)
+        for mb_id in mb_ids:
+            start = mb_id * self.batch_size
+            yield self.windows[start:start + self.batch_size]
+
+
+def make_window_store(prep: Prep,
+                      key: str,
+                      ) -> WindowStore:
+    """
+    load windows of prep from cache, or save them to cache if not yet cached, and use them in place of prep's windows.
+    the windows of prep are accessed only if they are not yet cached.
+    """
+    windows = load_windows(key)
+    if windows is None:
+        save_windows(key, prep.reordered_windows)
+        windows = load_windows(key)
+
+    window_store = WindowStore(windows, prep.batch_size)
+    assert window_store.num_mbs == prep.num_mbs, (window_store.num_mbs, prep.num_mbs)
+    prep2window_store[prep] = window_store
+    return window_store
+
+
+def get_window_store(prep: Prep,
+                     ) -> WindowStore:
+    """
+    return the window store of prep, or a store of the in-memory windows of prep if none has been made
+    """
+    if prep not in prep2window_store:
+        prep2window_store[prep] = WindowStore(prep.reordered_windows, prep.batch_size)
+    return prep2window_store[prep]
@@ -0,0 +1,14 @@
+"""
+compact the csv files of all jobs under the runs directory into one parquet index per param setting.
+plot scripts read from the index, if it exists, which is much faster on the network-mounted file server.
+run again after new jobs complete - only new or modified csv files are read.
+"""
+from pathlib import Path
+
+from childesrnnlm import __name__
+from childesrnnlm.aggregation import aggregate_results
+
+LUDWIG_DATA_PATH: Path = Path('/media/ludwig_data')
+RUNS_PATH: Path = LUDWIG_DATA_PATH / __name__ / 'runs'
+
+aggregate_results(RUNS_PATH)
@@ -6,7 +6,7 @@ from ludwig.results import gen_param_paths
 
 from childesrnnlm import __name__, configs
 from childesrnnlm.figs import make_summary_fig
-from childesrnnlm.summary import make_summary
+from childesrnnlm.summary import make_summaries
 from childesrnnlm.params import param2default, param2requests, Params
 
 LUDWIG_DATA_PATH: Optional[Path] = Path('/media/ludwig_data')
@@ -32,8 +32,10 @@ elif BA_TYPE == 'ba_o':
 else:
     raise AttributeError('Invalid BA_TYPE')
 
-# collect summaries
-summaries = []
+# collect param paths
+param_paths = []
+labels = []
+shift_xs = []
 project_name = __name__
 for param_path, label in gen_param_paths(project_name,
                                          param2requests,
@@ -57,11 +59,13 @@ for param_path, label in gen_param_paths(project_name,
     else:
         num_shifted_steps = None
 
-    pattern = f'{BA_TYPE}_{PROBES_NAME}'
-    summary = make_summary(pattern, param_path, label, CONFIDENCE, num_shifted_steps)
-    summaries.append(summary)   # summary contains: x, mean_y, std_y, label, n
-    print(f'--------------------- End section {param_path.name}')
-    print()
+    param_paths.append(param_path)
+    labels.append(label)
+    shift_xs.append(num_shifted_steps)
+
+# collect summaries concurrently
+pattern = f'{BA_TYPE}_{PROBES_NAME}'
+summaries = make_summaries(pattern, param_paths, labels, CONFIDENCE, shift_xs)  # contain: x, mean_y, std_y, label, n
 
 # sort data
 summaries = sorted(summaries, key=lambda s: s[1][-1], reverse=True)
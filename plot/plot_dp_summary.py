@@ -1,13 +1,11 @@
-import pandas as pd
 from typing import Optional, List, Tuple
 from pathlib import Path
-import numpy as np
-from scipy.stats import t, sem
 
 from ludwig.results import gen_param_paths
 
 from childesrnnlm import __name__
 from childesrnnlm.figs import make_summary_fig
+from childesrnnlm.summary import make_summaries
 from childesrnnlm.params import param2default, param2requests
 
 LUDWIG_DATA_PATH: Optional[Path] = Path('/media/ludwig_data')
@@ -26,26 +24,9 @@ CONFIDENCE = 0.95
 TITLE = ''  # f'{DP_PROBES_NAME}\npartition={PART_ID}'
 
 
-
-def make_summary(pp, lb) -> Tuple[np.ndarray, np.ndarray, np.ndarray, str, int]:
-    """
-    load all csv files for dp-unconditional plot
-    """
-    pattern = f'dp_{DP_PROBES_NAME}_{METRIC}.csv'
-    series_list = [pd.read_csv(p, index_col=0, squeeze=True) for p in pp.rglob(pattern)]
-    n = len(series_list)
-    if not series_list:
-        raise RuntimeError(f'Did not find any csv files matching pattern="{pattern}"')
-    concatenated_df = pd.concat(series_list, axis=1)
-    y_mean = concatenated_df.mean(axis=1).values.flatten()
-    y_sem = sem(concatenated_df.values, axis=1)
-    h = y_sem * t.ppf((1 + CONFIDENCE) / 2, n - 1)  # margin of error
-
-    return concatenated_df.index.values, y_mean, h, lb, n
-
-
-# collect summaries
-summaries = []
+# collect param paths
+param_paths = []
+labels = []
 project_name = __name__
 for param_path, label in gen_param_paths(project_name,
                                          param2requests,
@@ -53,9 +34,12 @@ for param_path, label in gen_param_paths(project_name,
                                          runs_path=RUNS_PATH,
                                          ludwig_data_path=LUDWIG_DATA_PATH,
                                          label_n=LABEL_N):
-    # collect for comparison figure
-    summary = make_summary(param_path, label)
-    summaries.append(summary)
+    param_paths.append(param_path)
+    labels.append(label)
+
+# collect summaries concurrently
+pattern = f'dp_{DP_PROBES_NAME}_{METRIC}'
+summaries = make_summaries(pattern, param_paths, labels, CONFIDENCE)  # contain: x, mean_y, std_y, label, n
 
 # plot comparison
 fig = make_summary_fig(summaries,
@@ -5,7 +5,7 @@ from ludwig.results import gen_param_paths
 
 from childesrnnlm import __name__
 from childesrnnlm.figs import make_summary_fig
-from childesrnnlm.summary import make_summary
+from childesrnnlm.summary import make_summaries
 from childesrnnlm.params import param2default, param2requests
 
 LUDWIG_DATA_PATH: Optional[Path] = Path('/media/ludwig_data')
@@ -31,8 +31,9 @@ elif SI_TYPE == 'si_o':
 else:
     raise AttributeError('Invalid SI_TYPE')
 
-# collect summaries
-summaries = []
+# collect param paths
+param_paths = []
+labels = []
 project_name = __name__
 for p, label in gen_param_paths(project_name,
                                 param2requests,
@@ -40,11 +41,12 @@ for p, label in gen_param_paths(project_name,
                                 runs_path=RUNS_PATH,
                                 ludwig_data_path=LUDWIG_DATA_PATH,
                                 label_n=LABEL_N):
-    pattern = f'{SI_TYPE}_{PROBES_NAME}'
-    summary = make_summary(pattern, p, label, CONFIDENCE)  # summary contains: x, mean_y, std_y, label, n
-    summaries.append(summary)
-    print(f'--------------------- End section {p.name}')
-    print()
+    param_paths.append(p)
+    labels.append(label)
+
+# collect summaries concurrently
+pattern = f'{SI_TYPE}_{PROBES_NAME}'
+summaries = make_summaries(pattern, param_paths, labels, CONFIDENCE)  # each contains: x, mean_y, std_y, label, n
 
 # sort data
 summaries = sorted(summaries, key=lambda s: s[1][-1], reverse=True)